@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class Category(models.Model):
+    """Category the benchmark items belong to."""
+
+    title = models.CharField(max_length=100)
+
+    class Meta:
+        ordering = ('-title',)
+
+
+class Item(models.Model):
+    """Model the benchmark fixtures are made of."""
+
+    category = models.ForeignKey(Category)
+    name = models.CharField(max_length=100)
+    email = models.EmailField()
+    created = models.DateTimeField()
+    score = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'benchmark items'
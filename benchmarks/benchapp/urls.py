@@ -0,0 +1,15 @@
+from django.conf.urls import patterns, url
+from django.http import HttpResponse
+
+
+def view(request, *args, **kwargs):
+    return HttpResponse('')
+
+
+urlpatterns = patterns('',
+    url(r'^items/$', view, name='items'),
+    url(r'^items/(\d+)/$', view, name='item'),
+    url(r'^sections/(\w+)/$', view, name='section'),
+    url(r'^objects/(?P<content_type>[\w.]+)/(?P<object_id>\d+)/$', view,
+        name='object'),
+)
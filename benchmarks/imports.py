@@ -0,0 +1,94 @@
+"""Import time benchmark for the panomena_general modules.
+
+Imports each module in a fresh interpreter with the settings configured
+but nothing else loaded, and reports the best time and the amount of
+modules the import pulled in. Modules over their budget are reported
+and the exit status is non-zero.
+
+    python benchmarks/imports.py
+    python benchmarks/imports.py --repeat 10 --scale 2
+
+"""
+import os
+import sys
+import json
+import time
+import optparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# budgets per module of (milliseconds, modules loaded by the import),
+# two to three times the best times and about twice the counts measured
+# with Python 2.7 and Django 1.5, use --scale on slower machines
+BUDGETS = {
+    'panomena_general.utils': (15, 25),
+    'panomena_general.content_types': (5, 10),
+    'panomena_general.url_builders': (20, 40),
+    'panomena_general.instrumentation': (15, 30),
+    'panomena_general.templatetags.general': (30, 60),
+}
+
+
+def child(name):
+    """Imports the module and prints its import time and module count."""
+    sys.path.insert(0, os.path.join(ROOT, '..', 'src'))
+    from django.conf import settings
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.contenttypes', 'panomena_general'],
+        SECRET_KEY='benchmarks',
+    )
+    modules = len(sys.modules)
+    start = time.time()
+    __import__(name)
+    elapsed = time.time() - start
+    print json.dumps({
+        'time': elapsed,
+        'modules': len(sys.modules) - modules,
+    })
+
+
+def measure(name, repeat):
+    """Returns the best import time and the module count of a module,
+    each import done in a fresh interpreter.
+
+    """
+    results = []
+    for n in range(repeat):
+        output = subprocess.check_output([sys.executable,
+            os.path.abspath(__file__), '--child', name])
+        results.append(json.loads(output))
+    return min([result['time'] for result in results]), \
+        results[0]['modules']
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--repeat', type='int', default=5,
+        help='imports per module, the best is kept [%default]')
+    parser.add_option('--scale', type='float', default=1.0,
+        help='factor applied to the time budgets [%default]')
+    options, args = parser.parse_args()
+    if options.child:
+        return child(options.child)
+    overruns = 0
+    for name in sorted(BUDGETS):
+        budget_ms, budget_modules = BUDGETS[name]
+        budget_ms *= options.scale
+        elapsed, modules = measure(name, options.repeat)
+        flags = []
+        if elapsed * 1000 > budget_ms:
+            flags.append('slow')
+        if modules > budget_modules:
+            flags.append('too many modules')
+        if flags: overruns += 1
+        print '%-40s %7.1fms / %5.1fms %5d / %3d modules %s' % (name,
+            elapsed * 1000, budget_ms, modules, budget_modules,
+            ', '.join(flags))
+    if overruns:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
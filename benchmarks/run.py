@@ -0,0 +1,358 @@
+"""Benchmark suite for the panomena_general utilities and template tags.
+
+Runs against an in-memory SQLite database filled with fixtures of each
+requested size and reports, per operation, the mean time, the database
+queries and the net amount of objects left allocated per call. Before
+timing, the keyset page navigation is checked against the fixtures.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 100,10000 --save baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 1.25
+
+When comparing, operations that got slower than the threshold allows or
+make more queries than the baseline are reported and the exit status is
+non-zero.
+
+"""
+import os
+import gc
+import sys
+import json
+import time
+import datetime
+import optparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, '..', 'src'))
+sys.path.insert(0, ROOT)
+
+from django.conf import settings
+settings.configure(
+    DEBUG=True,
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+    },
+    INSTALLED_APPS=[
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'panomena_general',
+        'benchapp',
+    ],
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    },
+    ROOT_URLCONF='benchapp.urls',
+    TEMPLATE_DIRS=[os.path.join(ROOT, 'templates')],
+    SECRET_KEY='benchmarks',
+    BENCHMARK_SETTING='value',
+)
+
+from django.db import connection, reset_queries
+from django.core.management import call_command
+from django.template import Template, Context
+from django.test.client import RequestFactory
+
+from panomena_general import utils
+from panomena_general.fields import CommaSeparatedEmailField, \
+    CommaSeparatedLookupField
+
+from benchapp.models import Category, Item
+
+
+# sizes of the fixtures benchmarked when none are given
+DEFAULT_SIZES = '100,1000'
+
+# objects listed on a page or looped over in the templates
+PAGE_SIZE = 50
+
+# time per call, in seconds, each operation is repeated for
+TARGET_TIME = 0.2
+
+
+class URLCallable(object):
+    """Url callable for the new_smart_url tag."""
+
+    do_not_call_in_templates = True
+
+    def __call__(self, obj):
+        return '/items/%d/' % obj.pk
+
+
+class Feed(object):
+    """Iterable generating objects without a length or slicing."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __iter__(self):
+        return (n for n in xrange(self.size))
+
+
+def create_fixtures(size):
+    """Replaces the benchmark items with a fresh set of the given size."""
+    Item.objects.all().delete()
+    Category.objects.all().delete()
+    categories = [Category.objects.create(title='Category %d' % n)
+        for n in range(10)]
+    start = datetime.datetime(2012, 1, 1)
+    Item.objects.bulk_create([Item(
+        category=categories[n % 10],
+        name='item%d' % n,
+        email='item%d@example.com' % n,
+        created=start + datetime.timedelta(minutes=n),
+        score=n,
+    ) for n in range(size)])
+
+
+def render(source, **context):
+    """Returns a callable rendering the template source with the given
+    context and a request for '/items/3/?page=2'.
+
+    """
+    template = Template('{% load general %}' + source)
+    factory = RequestFactory()
+    def run():
+        request = factory.get('/items/3/', {'page': '2', 'next': '/'})
+        data = {'request': request}
+        data.update(context)
+        return template.render(Context(data))
+    return run
+
+
+def operations(size):
+    """Returns a list of (name, callable) tuples of the operations to
+    benchmark against fixtures of the given size.
+
+    """
+    items = Item.objects.all()
+    page = list(items[:PAGE_SIZE])
+    user = URLCallable()
+    emails = ', '.join(['user%d@Example.com' % n for n in range(size)])
+    lookups = ', '.join(['item%d' % n for n in range(min(size, 500))])
+    payload = [{'id': n, 'name': 'item%d' % n} for n in range(PAGE_SIZE)]
+    lookup_field = CommaSeparatedLookupField(Item,
+        lambda value: (['name'], value))
+    ifhere = ''.join(["{%% ifhere section 's%d' %%}x{%% endifhere %%}" % n
+        for n in range(19)]) + '{% ifhere item 3 %}here{% endifhere %}'
+    return [
+        ('tag.paging', render(
+            "{% paging items 'page' 50 %}{% for o in page %}{% endfor %}",
+            items=items)),
+        ('tag.paging.keyset', render(
+            "{% paging items 'page' 50 order_by=-created %}"
+            "{% for o in page %}{% endfor %}", items=items)),
+        ('tag.paging.select_related', render(
+            "{% paging items 'page' 50 select_related=category %}"
+            "{% for o in page.object_list %}{{ o.category.title }}"
+            "{% endfor %}", items=items)),
+        ('tag.paging.values', render(
+            "{% paging items 'page' 50 values=name,score %}"
+            "{% for o in page.object_list %}{{ o.name }}{% endfor %}",
+            items=items)),
+        ('tag.paging.generator', render(
+            "{% paging items 'page' 50 %}{% for o in page %}{% endfor %}",
+            items=Feed(size))),
+        ('tag.paging.cached_count', render(
+            "{% paging items 'page' 50 count_timeout=60 %}"
+            "{% for o in page %}{% endfor %}", items=items)),
+        ('tag.paging_render', render(
+            "{% paging items 'page' 50 %}"
+            "{% paging_render page 'page' 'Items' 'paging.html' %}"
+            "{% paging_render page 'page' 'Items' 'paging.html' %}",
+            items=items)),
+        ('tag.ifhere', render(ifhere)),
+        ('tag.url_next', render(
+            "{% for o in page %}{% url_next 'item' o.pk %}{% endfor %}",
+            page=page)),
+        ('tag.new_smart_url', render(
+            "{% for o in page %}{% new_smart_url user o as url %}"
+            "{{ url }}{% endfor %}", page=page, user=user)),
+        ('tag.content_type', render(
+            "{% for o in page %}{% content_type o as ct %}{{ ct.model }}"
+            "{% endfor %}", page=page)),
+        ('tag.content_object_url', render(
+            "{% for o in page %}{% content_object_url 'object' o %}"
+            "{% endfor %}", page=page)),
+        ('tag.verbose_name_plural', render(
+            "{% for o in page %}{% verbose_name_plural o %}{% endfor %}",
+            page=page)),
+        ('tag.setting', render(
+            "{% for o in page %}{% setting 'BENCHMARK_SETTING' %}"
+            "{% endfor %}", page=page)),
+        ('field.email', lambda: CommaSeparatedEmailField().clean(emails)),
+        ('field.lookup', lambda: list(lookup_field.clean(lookups))),
+        ('utils.get_content_type',
+            lambda: utils.get_content_type('benchapp.item')),
+        ('utils.generate_filename',
+            lambda: utils.generate_filename('jpg')),
+        ('utils.class_from_string',
+            lambda: utils.class_from_string('benchapp.models.Item')),
+        ('utils.get_setting',
+            lambda: utils.get_setting('BENCHMARK_SETTING', 'benchmarks')),
+        ('utils.parse_kw_args', lambda: utils.parse_kw_args('tag',
+            ['a=1', 'b=2', 'c=3'], {'a': int, 'b': r'^\d$', 'c': None},
+            restrict=True)),
+        ('utils.formfield_extractor', lambda: utils.formfield_extractor(
+            Item, {'name': {'required': False}})),
+        ('utils.base64_url_decode',
+            lambda: utils.base64_url_decode('eyJhIjogMX0')),
+        ('utils.json_response', lambda: utils.json_response(payload)),
+        ('utils.json_response.cached', lambda: utils.json_response(payload,
+            etag=True, cache_key='payload', version=1)),
+        ('utils.iter_json', lambda: list(utils.iter_json(items))),
+    ]
+
+
+def check_keyset_navigation():
+    """Walks forward through all the keyset pages of the fixtures and
+    back again, checking every item is seen once and in order, and that
+    invalid orderings and cursors are rejected.
+
+    """
+    from django.core.exceptions import ImproperlyConfigured
+    from panomena_general.paginator import KeysetPaginator, InvalidPage
+    for order_by in ('-created', 'score,-created', 'name'):
+        for per_page in (7, PAGE_SIZE):
+            paginator = KeysetPaginator(Item.objects.all(), per_page,
+                order_by)
+            expected = list(Item.objects.order_by(
+                *paginator._order_by(False)).values_list('pk', flat=True))
+            # forward
+            pages, page = [], paginator.page()
+            assert not page.has_previous()
+            while True:
+                pages.append([obj.pk for obj in page])
+                if not page.has_next(): break
+                page = paginator.page(page.next_page_number())
+            assert sum(pages, []) == expected, order_by
+            # backward from the last page
+            seen = [pages[-1]]
+            while page.has_previous():
+                page = paginator.page(page.previous_page_number())
+                seen.insert(0, [obj.pk for obj in page])
+            assert seen == pages, order_by
+    # categories are ordered by title, which the seek on the key of a
+    # relation cannot follow
+    for order_by in ('category', '-category,score', 'category__title',
+                     'missing'):
+        try:
+            KeysetPaginator(Item.objects.all(), 10, order_by)
+        except ImproperlyConfigured:
+            pass
+        else:
+            raise AssertionError('%s accepted' % order_by)
+    paginator = KeysetPaginator(Item.objects.all(), 10, '-created')
+    for cursor in ('garbage', 'WyJuIixbbnVsbCxudWxsXV0',
+                   'WyJuIixbIm5vdCBhIGRhdGUiLCIxIl1d'):
+        try:
+            paginator.page(cursor)
+        except InvalidPage:
+            pass
+        else:
+            raise AssertionError('cursor %s accepted' % cursor)
+
+
+def measure(func):
+    """Returns the mean time, queries and net allocated objects of a
+    call to func, after a warm up call.
+
+    """
+    func()
+    # determine how many calls fit in the target time
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    calls = max(1, min(1000, int(TARGET_TIME / max(elapsed, 1e-6))))
+    # measure the calls with the collector paused
+    gc.collect()
+    gc.disable()
+    try:
+        reset_queries()
+        allocated = gc.get_count()[0]
+        start = time.time()
+        for n in range(calls):
+            func()
+        elapsed = time.time() - start
+        allocated = gc.get_count()[0] - allocated
+        queries = len(connection.queries)
+    finally:
+        gc.enable()
+    return {
+        'time': elapsed / calls,
+        'queries': queries / float(calls),
+        'objects': allocated / float(calls),
+    }
+
+
+def run(sizes, only=None):
+    """Runs the benchmarks for each fixture size, printing and returning
+    the results keyed by '<operation>@<size>'.
+
+    """
+    results = {}
+    call_command('syncdb', interactive=False, verbosity=0)
+    for size in sizes:
+        create_fixtures(size)
+        check_keyset_navigation()
+        for name, func in operations(size):
+            if only and not name.startswith(only): continue
+            key = '%s@%d' % (name, size)
+            result = results[key] = measure(func)
+            print '%-36s %10.1fus %8.1f queries %8.1f objects' % (key,
+                result['time'] * 1e6, result['queries'], result['objects'])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the changes against the baseline, returning the amount of
+    regressions.
+
+    """
+    regressions = 0
+    print
+    print '%-36s %10s %10s %8s' % ('operation', 'baseline', 'current',
+        'ratio')
+    for key in sorted(results):
+        if key not in baseline: continue
+        old, new = baseline[key], results[key]
+        ratio = new['time'] / max(old['time'], 1e-9)
+        flags = []
+        if ratio > threshold:
+            flags.append('slower')
+        if new['queries'] > old['queries']:
+            flags.append('more queries')
+        if flags: regressions += 1
+        print '%-36s %8.1fus %8.1fus %7.2fx %s' % (key, old['time'] * 1e6,
+            new['time'] * 1e6, ratio, ', '.join(flags))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=DEFAULT_SIZES,
+        help='comma separated fixture sizes [%default]')
+    parser.add_option('--only', help='only run operations starting with')
+    parser.add_option('--save', help='save the results to a json file')
+    parser.add_option('--compare', help='compare against a json file')
+    parser.add_option('--threshold', type='float', default=1.2,
+        help='slowdown ratio considered a regression [%default]')
+    options, args = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = run(sizes, options.only)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import threading
+
+
+def _content_type_model():
+    # imported when used so this module can be loaded before the models
+    from django.contrib.contenttypes.models import ContentType
+    return ContentType
+
+
+def _natural_key(model):
+    """Returns the natural key of the content type for a model class or
+    instance, resolving proxy and deferred classes to their concrete
+    model the same way the content type manager does.
+
+    """
+    opts = model._meta
+    concrete_model = getattr(opts, 'concrete_model', None)
+    if concrete_model is not None:
+        opts = concrete_model._meta
+    return (opts.app_label, opts.object_name.lower())
+
+
+class ContentTypeRegistry(object):
+    """Registry of all content types loaded with a single query and
+    looked up by natural key string, id or model without touching the
+    database once warm.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_key = None
+        self._by_id = None
+
+    def load(self):
+        """Loads all the content types in a single query."""
+        self.install(_content_type_model().objects.all())
+
+    def install(self, content_types):
+        """Fills the registry with already loaded content types, like
+        those read from a warmup snapshot.
+
+        """
+        by_key, by_id = {}, {}
+        for content_type in content_types:
+            by_key[(content_type.app_label, content_type.model)] = \
+                content_type
+            by_id[content_type.id] = content_type
+        connect_refresh()
+        with self._lock:
+            self._by_key, self._by_id = by_key, by_id
+
+    def all(self):
+        """Returns all the content types in the registry."""
+        by_key, by_id = self._tables()
+        return by_id.values()
+
+    def clear(self):
+        """Clears the registry, reloading it on next lookup."""
+        with self._lock:
+            self._by_key = self._by_id = None
+
+    def _tables(self):
+        by_key, by_id = self._by_key, self._by_id
+        if by_key is None:
+            with self._lock:
+                if self._by_key is None:
+                    self.load()
+                by_key, by_id = self._by_key, self._by_id
+        return by_key, by_id
+
+    def _add(self, content_type):
+        with self._lock:
+            if self._by_key is not None:
+                key = (content_type.app_label, content_type.model)
+                self._by_key[key] = content_type
+                self._by_id[content_type.id] = content_type
+        return content_type
+
+    def get_by_natural_key(self, app_label, model):
+        """Returns the content type for an app label and model name."""
+        by_key, by_id = self._tables()
+        content_type = by_key.get((app_label, model))
+        if content_type is None:
+            content_type = _content_type_model().objects.get_by_natural_key(
+                app_label, model)
+            self._add(content_type)
+        return content_type
+
+    def get(self, key):
+        """Returns the content type for an 'app_label.model' string."""
+        return self.get_by_natural_key(*key.split('.'))
+
+    def get_for_id(self, id):
+        """Returns the content type with the given id."""
+        by_key, by_id = self._tables()
+        content_type = by_id.get(id)
+        if content_type is None:
+            content_type = self._add(
+                _content_type_model().objects.get_for_id(id))
+        return content_type
+
+    def get_for_model(self, model):
+        """Returns the content type for a model class or instance."""
+        by_key, by_id = self._tables()
+        content_type = by_key.get(_natural_key(model))
+        if content_type is None:
+            content_type = _content_type_model().objects.get_for_model(
+                model)
+            self._add(content_type)
+        return content_type
+
+
+content_types = ContentTypeRegistry()
+
+
+def refresh_content_types(sender, **kwargs):
+    """Signal handler that reloads the registry after migrations."""
+    content_types.clear()
+
+
+def connect_refresh():
+    """Connects the refresh handler to the post migrate signal, done
+    when the registry is first filled.
+
+    """
+    from django.db.models import signals
+    # post_migrate replaced post_syncdb in newer versions of django
+    post_migrate = getattr(signals, 'post_migrate', None) or \
+        signals.post_syncdb
+    post_migrate.connect(refresh_content_types,
+        dispatch_uid='panomena_general.content_types.refresh')
@@ -1,5 +1,10 @@
+import re
+
 from django import forms
+from django.db import connections
 from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.constants import QUERY_TERMS
 from django.forms import widgets
 from django.core.validators import email_re
 from django.utils.translation import ugettext_lazy as _
@@ -17,42 +22,103 @@ class CommaSeparatedInput(widgets.Textarea):
         return super(CommaSeparatedInput, self).render(name, value, attrs)
 
 
+EMAIL_SEPARATOR_RE = re.compile(r'[,;\n]')
+
+
+def split_addresses(value):
+    """Yields the stripped, non blank parts of a string of addresses
+    separated by commas, semicolons or newlines, one at a time.
+
+    """
+    start = 0
+    for match in EMAIL_SEPARATOR_RE.finditer(value):
+        part = value[start:match.start()].strip()
+        if part: yield part
+        start = match.end()
+    part = value[start:].strip()
+    if part: yield part
+
+
 class CommaSeparatedEmailField(forms.Field):
-    """Comma seperated email form field."""
+    """Comma seperated email form field. Addresses may also be separated
+    by semicolons or newlines and are deduplicated ignoring the case of
+    their domain. The size of the input is checked before it is parsed
+    and parsing stops as soon as there are too many addresses. Invalid
+    addresses are reported as a list of messages, capped at max_errors,
+    with the full list kept in the invalid attribute.
+
+    """
+
+    default_error_messages = {
+        'invalid': _(u"'%s' is not a valid email address."),
+        'invalid_more': _(u"%d more addresses are not valid."),
+        'max_length': _(u"Ensure the addresses have at most %d " \
+            "characters (they have %d)."),
+        'max_count': _(u"Ensure there are at most %d addresses."),
+    }
 
     widget = CommaSeparatedInput
-    
+
+    def __init__(self, *args, **kwargs):
+        self.max_length = kwargs.pop('max_length', None)
+        self.max_count = kwargs.pop('max_count', None)
+        self.max_errors = kwargs.pop('max_errors', 10)
+        self.invalid = []
+        super(CommaSeparatedEmailField, self).__init__(*args, **kwargs)
+
     def clean(self, value):
+        error_messages = self.error_messages
         value = super(CommaSeparatedEmailField, self).clean(value)
+        self.invalid = []
         # return blank for empty field
         if not value: return ''
         # return value if already a list
         if isinstance(value, (list, tuple)):
             return value
-        # separate addresses and validate each one
-        invalid = []
-        emails = set([v.strip() for v in value.split(',')])
-        for email in emails:
-            match = email_re.match(email)
-            if match is None:
-                invalid.append(email)
-        # raise validation error if any address has failed
-        if len(invalid) > 0:
-            raise forms.ValidationError(
-                _("The following addresses are incorrect: %s" \
-                % ', '.join(invalid)))
+        # check the size of the input before parsing it
+        if self.max_length and len(value) > self.max_length:
+            raise forms.ValidationError(error_messages['max_length'] % \
+                (self.max_length, len(value)))
+        # separate addresses removing duplicates, ignoring domain case,
+        # and stop once there are too many
+        emails = set()
+        for email in split_addresses(value):
+            local, at, domain = email.rpartition('@')
+            if at: email = '%s@%s' % (local, domain.lower())
+            emails.add(email)
+            if self.max_count and len(emails) > self.max_count:
+                raise forms.ValidationError(error_messages['max_count'] % \
+                    self.max_count)
+        # validate each address
+        invalid = self.invalid = sorted([email for email in emails
+            if email_re.match(email) is None])
+        # raise validation error listing the failed addresses
+        if invalid:
+            messages = [error_messages['invalid'] % email
+                for email in invalid[:self.max_errors]]
+            more = len(invalid) - self.max_errors
+            if more > 0:
+                messages.append(error_messages['invalid_more'] % more)
+            raise forms.ValidationError(messages)
         return emails
 
 
 class CommaSeparatedLookupField(forms.Field):
     """Field for looking up an array of objects using values of
     specified model fields, determined by a method that analises
-    each provided value.
+    each provided value. Identified values are grouped by field into
+    chunked in lookups and values that matched nothing are recorded
+    in the unmatched attribute. Values of fields ending in a query
+    term, like title__iexact, are looked up with a query each as what
+    they matched can not be read back. Text is compared ignoring case
+    when ignore_case is set, which defaults to doing so on MySQL where
+    the default collations are case insensitive.
     
     """
 
     default_error_messages = {
         'unidentified': _(u"The '%s' value could not be indentified."),
+        'unmatched': _(u"No match was found for: %s"),
     }
 
     widget = CommaSeparatedInput
@@ -60,25 +126,146 @@ class CommaSeparatedLookupField(forms.Field):
     def __init__(self, model, identify, *args, **kwargs):
         self.model = model
         self.identify = identify
+        self.identify_many = kwargs.pop('identify_many', None)
+        self.chunk_size = kwargs.pop('chunk_size', 500)
+        self.require_match = kwargs.pop('require_match', False)
+        self.ignore_case = kwargs.pop('ignore_case', None)
+        self.unmatched = []
         super(CommaSeparatedLookupField, self).__init__(*args, **kwargs)
 
-    def clean(self, value):
+    def identify_values(self, values):
+        """Identifies all the values, using the bulk identify method
+        when one was supplied.
+
+        """
+        if self.identify_many is not None:
+            return self.identify_many(values)
+        return [self.identify(value) for value in values]
+
+    def group_values(self, values):
+        """Groups the lookup values by field, mapping each lookup value
+        to the provided values it was identified from.
+
+        """
         error_messages = self.error_messages
-        value = super(CommaSeparatedLookupField, self).clean(value)
-        # return empty list for empty field
-        if not value: return []
-        # build the query
-        query = Q()
-        values = [v.strip() for v in value.split(',')]
-        # use the identify method if available
-        for value in values:
-            result = self.identify(value)
+        lookups = {}
+        for value, result in zip(values, self.identify_values(values)):
             if result is None:
                 raise forms.ValidationError(
                     error_messages['unidentified'] % value)
-            fields, value = result
+            fields, lookup_value = result
             for field in fields:
-                query = query | Q(**{field: value})
-        # return the results
-        return self.model.objects.filter(query).all()
+                lookup = lookups.setdefault(field, {})
+                lookup.setdefault(lookup_value, []).append(value)
+        return lookups
+
+    def model_field(self, lookup):
+        """Returns the model field a lookup path ends at, following
+        foreign keys to the field they refer to, or None.
+
+        """
+        model, field = self.model, None
+        for name in lookup.split('__'):
+            if field is not None:
+                if getattr(field, 'rel', None) is None: return None
+                model = field.rel.to
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+        while getattr(field, 'rel', None) is not None:
+            field = field.rel.get_related_field()
+        return field
+
+    def folds_case(self):
+        """Determines if the database compares text ignoring case."""
+        if self.ignore_case is not None:
+            return self.ignore_case
+        return connections[self.model.objects.db].vendor == 'mysql'
+
+    def comparable(self, field, value, ignore_case=False):
+        """Converts a lookup value or a value read from the database to
+        the form they are compared in. Values are converted by the model
+        field and text is lowercased when case is ignored.
+
+        """
+        if field is not None:
+            try:
+                value = field.to_python(value)
+            except (forms.ValidationError, TypeError, ValueError):
+                pass
+        if ignore_case and isinstance(value, basestring):
+            value = value.lower()
+        return value
 
+    def match(self, lookups):
+        """Runs the lookups in chunks, returning the primary keys found
+        and the set of provided values that matched an object.
+
+        """
+        pairs = [(field, lookup_value) for field, lookup in lookups.items()
+            for lookup_value in lookup]
+        # index the provided values by their comparable lookup value
+        fields = dict([(field, self.model_field(field))
+            for field in lookups])
+        ignore_case = self.folds_case()
+        index = {}
+        for field, lookup in lookups.items():
+            values = index[field] = {}
+            for lookup_value, provided in lookup.items():
+                key = self.comparable(fields[field], lookup_value,
+                    ignore_case)
+                values.setdefault(key, []).extend(provided)
+        pks, matched = set(), set()
+        for i in range(0, len(pairs), self.chunk_size):
+            chunk = {}
+            for field, lookup_value in pairs[i:i + self.chunk_size]:
+                chunk.setdefault(field, []).append(lookup_value)
+            # build the query with an in lookup per plain field
+            query, plain = Q(), []
+            for field, lookup_values in chunk.items():
+                if field.split('__')[-1] in QUERY_TERMS:
+                    # matches can't be read back for fields with terms
+                    for lookup_value in lookup_values:
+                        found = self.model.objects.filter(**{
+                            field: lookup_value}).values_list('pk',
+                            flat=True)
+                        if found:
+                            pks.update(found)
+                            matched.update(lookups[field][lookup_value])
+                else:
+                    query = query | Q(**{'%s__in' % field: lookup_values})
+                    plain.append(field)
+            if not plain: continue
+            # record which values matched
+            rows = self.model.objects.filter(query) \
+                .values_list('pk', *plain)
+            for row in rows:
+                pks.add(row[0])
+                for field, found in zip(plain, row[1:]):
+                    key = self.comparable(fields[field], found, ignore_case)
+                    matched.update(index[field].get(key, ()))
+        return pks, matched
+
+    def clean(self, value):
+        error_messages = self.error_messages
+        value = super(CommaSeparatedLookupField, self).clean(value)
+        self.unmatched = []
+        # return empty list for empty field
+        if not value: return []
+        # separate the values removing duplicates
+        values, seen = [], set()
+        for value in value.split(','):
+            value = value.strip()
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+        # look up the values in chunks
+        lookups = self.group_values(values)
+        pks, matched = self.match(lookups)
+        self.unmatched = [v for v in values if v not in matched]
+        if self.require_match and self.unmatched:
+            raise forms.ValidationError(
+                error_messages['unmatched'] % ', '.join(self.unmatched))
+        # return the results
+        return self.model.objects.filter(pk__in=list(pks))
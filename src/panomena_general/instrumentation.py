@@ -0,0 +1,179 @@
+import time
+import logging
+import threading
+
+from panomena_general.utils import cached_setting
+
+
+logger = logging.getLogger('panomena_general.instrumentation')
+
+# upper bounds of the render time histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, float('inf'))
+
+_local = threading.local()
+_histograms = {}
+_histograms_lock = threading.Lock()
+_originals = {}
+
+
+def _node_classes():
+    from panomena_general.templatetags import general
+    return [general.PagingNode, general.PagingRenderNode,
+        general.IfHereNode, general.URLNextNode, general.SmartURLNode,
+        general.SmartURLsNode,
+        general.ContentTypeNode, general.ContentObjectURLsNode,
+        general.SettingNode]
+
+
+def _record(name, elapsed, queries, hits):
+    # add to the request totals when collecting
+    totals = getattr(_local, 'totals', None)
+    if totals is not None:
+        total = totals.setdefault(name, [0, 0.0, 0, 0])
+        total[0] += 1
+        total[1] += elapsed
+        total[2] += queries
+        total[3] += hits
+    # add to the process wide histogram
+    ms = elapsed * 1000
+    with _histograms_lock:
+        histogram = _histograms.setdefault(name,
+            [0] * len(HISTOGRAM_BUCKETS))
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bound:
+                histogram[i] += 1
+                break
+
+
+def _connection():
+    # imported when used so loading this module stays cheap
+    from django.db import connection
+    return connection
+
+
+def _instrument(node_class):
+    connection = _connection()
+    render = node_class.render
+    name = node_class.__name__
+    def instrumented_render(self, context):
+        frames = _local.__dict__.setdefault('frames', [])
+        frames.append(0)
+        queries = len(connection.queries)
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            elapsed = time.time() - start
+            hits = frames.pop()
+            _record(name, elapsed, len(connection.queries) - queries, hits)
+    instrumented_render.__doc__ = render.__doc__
+    return render, instrumented_render
+
+
+def enable():
+    """Instruments the render methods of the template tag nodes. Queries
+    are only counted where the debug cursor is used, like in debug mode
+    or during requests handled by the middleware.
+
+    """
+    for node_class in _node_classes():
+        if node_class in _originals: continue
+        original, instrumented = _instrument(node_class)
+        _originals[node_class] = original
+        node_class.render = instrumented
+
+
+def disable():
+    """Restores the original render methods of the template tag nodes."""
+    for node_class, render in _originals.items():
+        node_class.render = render
+    _originals.clear()
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def cache_hit():
+    """Records a cache hit for the tag node being rendered."""
+    frames = getattr(_local, 'frames', None)
+    if frames:
+        frames[-1] += 1
+
+
+def start_collecting():
+    """Starts collecting tag totals for the current thread."""
+    _local.totals = {}
+
+
+def stop_collecting():
+    """Stops collecting and returns the tag totals as a dict of tag name
+    to (calls, seconds, queries, cache hits).
+
+    """
+    totals = getattr(_local, 'totals', None) or {}
+    _local.totals = None
+    return dict([(name, tuple(total)) for name, total in totals.items()])
+
+
+def format_totals(totals):
+    """Formats tag totals for a header or log line."""
+    return '; '.join(['%s=%d/%.1fms/%dq/%dh' % (name, calls,
+        seconds * 1000, queries, hits) for name, (calls, seconds, queries,
+        hits) in sorted(totals.items())])
+
+
+def histograms():
+    """Returns the process wide render time histograms as a dict of tag
+    name to counts per bucket of HISTOGRAM_BUCKETS.
+
+    """
+    with _histograms_lock:
+        return dict([(name, list(counts)) for name, counts
+            in _histograms.items()])
+
+
+def reset_histograms():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+class TagInstrumentationMiddleware(object):
+    """Middleware that enables the tag instrumentation when the
+    PANOMENA_INSTRUMENT_TAGS setting is true and logs the totals of each
+    request. The totals are also sent in the X-Tag-Timing header when
+    the PANOMENA_INSTRUMENT_HEADER setting is true, which defaults to
+    the DEBUG setting. The debug cursor is only switched on for the
+    request, as the queries it keeps are not cleared outside requests.
+
+    """
+
+    def __init__(self):
+        if cached_setting('PANOMENA_INSTRUMENT_TAGS', False):
+            enable()
+
+    def process_request(self, request):
+        if is_enabled():
+            connection = _connection()
+            _local.debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            start_collecting()
+
+    def process_response(self, request, response):
+        # restore the debug cursor of the connection
+        if hasattr(_local, 'debug_cursor'):
+            _connection().use_debug_cursor = _local.debug_cursor
+            del _local.debug_cursor
+        if not is_enabled():
+            return response
+        totals = stop_collecting()
+        if totals:
+            line = format_totals(totals)
+            # the header is only sent in debug mode unless configured
+            header = cached_setting('PANOMENA_INSTRUMENT_HEADER', None)
+            if header is None:
+                header = cached_setting('DEBUG', False)
+            if header:
+                response['X-Tag-Timing'] = line
+            logger.debug('%s %s', request.path, line)
+        return response
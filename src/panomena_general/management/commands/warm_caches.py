@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from panomena_general.warmup import warmup, write_snapshot
+
+
+class Command(BaseCommand):
+    """Fills the content type and url caches and optionally writes them
+    to a snapshot file for workers to load at boot.
+
+    """
+
+    help = 'Warms the panomena_general content type and url caches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--snapshot', dest='snapshot', default=None,
+            help='Path of the snapshot file to write.'),
+    )
+
+    def handle(self, *args, **options):
+        warmup()
+        snapshot = options.get('snapshot')
+        if snapshot:
+            write_snapshot(snapshot)
+            self.stdout.write('Wrote snapshot to %s\n' % snapshot)
@@ -0,0 +1,534 @@
+import json
+import base64
+import hashlib
+import operator
+import itertools
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import EmptyQuerySet
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+from django.core.paginator import Paginator, Page, InvalidPage, \
+    PageNotAnInteger
+
+from panomena_general import instrumentation
+
+
+COUNT_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_invalidated_models = set()
+
+
+def _generation_key(model):
+    opts = model._meta
+    return 'panomena_general.count.gen.%s.%s' % (
+        opts.app_label, opts.object_name.lower())
+
+
+def invalidate_counts(sender, **kwargs):
+    """Signal handler that expires all cached counts of a model."""
+    key = _generation_key(sender)
+    if not cache.add(key, 1, COUNT_GENERATION_TIMEOUT):
+        try: cache.incr(key)
+        except ValueError: cache.set(key, 1, COUNT_GENERATION_TIMEOUT)
+
+
+def connect_count_invalidation(model):
+    """Expire cached counts of the model whenever it is saved or
+    deleted.
+
+    """
+    if model in _invalidated_models: return
+    uid = 'panomena_general.count.%s' % _generation_key(model)
+    post_save.connect(invalidate_counts, sender=model, dispatch_uid=uid)
+    post_delete.connect(invalidate_counts, sender=model, dispatch_uid=uid)
+    _invalidated_models.add(model)
+
+
+def compile_queryset(queryset):
+    """Returns the sql and parameters of a queryset, or None when the
+    queryset can not match any rows, like none() or an empty in lookup.
+
+    """
+    if isinstance(queryset, EmptyQuerySet):
+        return None
+    try:
+        return queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+
+
+def count_cache_key(queryset, options=()):
+    """Builds a cache key for the count of a queryset from its
+    compiled sql and parameters and the counting options, or returns
+    None when the queryset can not match any rows.
+
+    """
+    compiled = compile_queryset(queryset)
+    if compiled is None:
+        return None
+    sql, params = compiled
+    generation = cache.get(_generation_key(queryset.model), 0)
+    digest = hashlib.md5(repr((queryset.db, sql, params,
+        tuple(options)))).hexdigest()
+    return 'panomena_general.count.%s.%s' % (digest, generation)
+
+
+def estimated_count(queryset):
+    """Returns the query planner's row estimate for a queryset, or None
+    when the database backend can not provide one.
+
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    compiled = compile_queryset(queryset)
+    if compiled is None:
+        return 0
+    sql, params = compiled
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def shape_queryset(queryset, select_related=None, prefetch_related=None,
+                   only=None, values=None):
+    """Applies the loading options of a page to a queryset. Related
+    objects are joined or prefetched, fields restricted with only and in
+    values mode dictionaries of the given fields, or of all fields when
+    the sequence is empty, are returned instead of model instances.
+
+    """
+    if not hasattr(queryset, 'query'):
+        return queryset
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related and values is None:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    if only and values is None:
+        # keep the relations followed by select_related loaded
+        related = tuple([name.split('__')[0] for name
+            in select_related or ()])
+        queryset = queryset.only(*(tuple(only) + related))
+    if values is not None:
+        queryset = queryset.values(*values)
+    return queryset
+
+
+def parse_ordering(order_by):
+    """Parses an ordering string like '-created,name' into a list of
+    (field, descending) tuples, appending the primary key as a tie
+    breaker when it is not already part of the ordering.
+
+    """
+    ordering = []
+    for field in order_by.split(','):
+        field = field.strip()
+        if not field: continue
+        if field.startswith('-'):
+            ordering.append((field[1:], True))
+        else:
+            ordering.append((field, False))
+    names = [name for name, desc in ordering]
+    if 'pk' not in names and 'id' not in names:
+        desc = ordering[-1][1] if ordering else False
+        ordering.append(('pk', desc))
+    return ordering
+
+
+class CountingPaginator(Paginator):
+    """Paginator that can cache the count of a queryset, use the query
+    planner's estimate for large results or stop counting at a cap.
+
+    """
+
+    def __init__(self, object_list, per_page, timeout=None,
+                 invalidate=False, estimate=None, cap=None, shape=None,
+                 **kwargs):
+        super(CountingPaginator, self).__init__(object_list, per_page,
+            **kwargs)
+        self.shape = shape or {}
+        self.timeout = timeout
+        self.estimate = estimate
+        self.cap = cap
+        self.estimated = False
+        self.capped = False
+        if invalidate and hasattr(object_list, 'query'):
+            connect_count_invalidation(object_list.model)
+
+    def page(self, number):
+        """Returns the page for the number, its objects sliced from the
+        queryset shaped with the loading options while the count is
+        taken from the queryset as given.
+
+        """
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        object_list = shape_queryset(self.object_list, **self.shape)
+        return Page(object_list[bottom:top], number, self)
+
+    def _get_count(self):
+        if self._count is None:
+            if hasattr(self.object_list, 'query'):
+                self._count = self._queryset_count()
+            else:
+                super(CountingPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
+
+    def _queryset_count(self):
+        queryset = self.object_list
+        # attempt to use a cached count
+        if self.timeout:
+            key = count_cache_key(queryset, (self.estimate, self.cap))
+            # nothing to count or cache when no rows can match
+            if key is None:
+                return 0
+            cached = cache.get(key)
+            if cached is not None:
+                instrumentation.cache_hit()
+                count, self.estimated, self.capped = cached
+                return count
+        # determine and cache the count
+        count = self._query_count(queryset)
+        if self.timeout:
+            cache.set(key, (count, self.estimated, self.capped),
+                self.timeout)
+        return count
+
+    def _query_count(self, queryset):
+        if self.estimate is not None:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate >= self.estimate:
+                self.estimated = True
+                return estimate
+        if self.cap:
+            count = queryset.values('pk')[:self.cap + 1].count()
+            if count > self.cap:
+                self.capped = True
+                return self.cap
+            return count
+        return queryset.count()
+
+
+class KeysetPage(object):
+    """Page of objects fetched by seeking from a cursor instead of an
+    offset. Mirrors the parts of the Django page api used by paging
+    templates, with cursors taking the place of page numbers.
+
+    """
+
+    def __init__(self, object_list, paginator, cursor=None,
+                 next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.number = cursor
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<KeysetPage %s>' % (self.number or 'first')
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.next_cursor
+
+    def previous_page_number(self):
+        return self.previous_cursor
+
+
+class KeysetPaginator(object):
+    """Paginates a queryset by seeking past the ordering values of the
+    last object shown rather than using offsets, which avoids both the
+    count query and deep offset scans.
+
+    """
+
+    num_pages = None
+    count = None
+
+    def __init__(self, queryset, per_page, order_by, shape=None):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = parse_ordering(order_by)
+        self.fields = self._ordering_fields()
+        self.shape = dict(shape or {})
+        # the cursors need the ordering fields to be loaded
+        names = tuple([name for name, desc in self.ordering])
+        for option in ('only', 'values'):
+            if self.shape.get(option):
+                self.shape[option] = tuple(self.shape[option]) + names
+
+    def _ordering_fields(self):
+        """Returns the model fields of the ordering, rejecting related
+        and nullable fields the seek clauses cannot compare. Relations are
+        ordered by the ordering of the related model but would be sought
+        by their key.
+
+        """
+        opts = self.queryset.model._meta
+        fields = []
+        for name, desc in self.ordering:
+            if name == 'pk':
+                fields.append(opts.pk)
+                continue
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                raise ImproperlyConfigured('Cannot page by %r, keyset '
+                    'paging requires fields of the model' % name)
+            if field.null:
+                raise ImproperlyConfigured('Cannot page by %r, keyset '
+                    'paging requires fields that are not nullable' % name)
+            if field.rel is not None:
+                raise ImproperlyConfigured('Cannot page by %r, keyset '
+                    'paging requires fields that are not relations' % name)
+            fields.append(field)
+        return fields
+
+    def _ordering_value(self, obj, name, field):
+        if isinstance(obj, dict):
+            if name not in obj:
+                name = field.attname
+            return obj[name]
+        return getattr(obj, field.attname)
+
+    def encode_cursor(self, obj, direction):
+        """Builds an opaque cursor from the ordering values of an object."""
+        values = []
+        for (name, desc), field in zip(self.ordering, self.fields):
+            value = self._ordering_value(obj, name, field)
+            values.append(unicode(value))
+        data = json.dumps([direction, values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Decodes a cursor into its direction and ordering values."""
+        try:
+            cursor = str(cursor)
+            cursor += '=' * ((4 - len(cursor) % 4) % 4)
+            direction, values = json.loads(base64.urlsafe_b64decode(cursor))
+        except (TypeError, ValueError, UnicodeError):
+            raise InvalidPage('That cursor is not valid')
+        if direction not in ('n', 'p') or \
+            not isinstance(values, list) or \
+            len(values) != len(self.ordering):
+            raise InvalidPage('That cursor is not valid')
+        # convert the values so the seek clauses can compare them
+        try:
+            values = [field.to_python(value) for field, value
+                in zip(self.fields, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidPage('That cursor is not valid')
+        if None in values:
+            raise InvalidPage('That cursor is not valid')
+        return direction, values
+
+    def _order_by(self, reverse):
+        fields = []
+        for name, desc in self.ordering:
+            desc = desc != reverse
+            fields.append('-%s' % name if desc else name)
+        return fields
+
+    def _seek(self, values, reverse):
+        clauses = []
+        for i, (name, desc) in enumerate(self.ordering):
+            lookup = 'lt' if desc != reverse else 'gt'
+            clause = Q(**{'%s__%s' % (name, lookup): values[i]})
+            for (prev_name, prev_desc), value in \
+                zip(self.ordering[:i], values[:i]):
+                clause &= Q(**{prev_name: value})
+            clauses.append(clause)
+        return reduce(operator.or_, clauses)
+
+    def page(self, cursor=None):
+        """Returns the page that follows or precedes the cursor, or the
+        first page if no cursor is given.
+
+        """
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+        else:
+            direction, values = 'n', None
+        reverse = direction == 'p'
+        queryset = self.queryset.order_by(*self._order_by(reverse))
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, reverse))
+        queryset = shape_queryset(queryset, **self.shape)
+        # fetch one extra row to determine if there is more to come
+        objects = list(queryset[:self.per_page + 1])
+        more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if reverse:
+            objects.reverse()
+        # build cursors relative to the edges of the page
+        next_cursor = previous_cursor = None
+        if objects:
+            if more or reverse:
+                next_cursor = self.encode_cursor(objects[-1], 'n')
+            if (more and reverse) or (values is not None and not reverse):
+                previous_cursor = self.encode_cursor(objects[0], 'p')
+        return KeysetPage(objects, self, cursor, next_cursor,
+            previous_cursor)
+
+
+def is_sliceable(object_list):
+    """Determines if objects can be sliced and counted the way the
+    Django paginator requires.
+
+    """
+    if not hasattr(object_list, '__getitem__') or not \
+        (hasattr(object_list, '__len__') or hasattr(object_list, 'count')):
+        return False
+    # sequences like xrange can be indexed but not sliced
+    try:
+        object_list[:0]
+    except (TypeError, KeyError):
+        return False
+    return True
+
+
+def known_length(object_list):
+    """Returns the length of an iterable when it has one, or None.
+    Length hints are not used as they are allowed to be wrong.
+
+    """
+    if not hasattr(object_list, '__len__'):
+        return None
+    try:
+        length = len(object_list)
+    except TypeError:
+        return None
+    return length
+
+
+class IterablePage(object):
+    """Page of objects read from an iterable. Whether there is a next
+    page is known from a single lookahead item, so the total is not
+    needed.
+
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+
+    def __repr__(self):
+        return '<IterablePage %s>' % self.number
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + \
+            len(self.object_list)
+
+
+class IterablePaginator(object):
+    """Paginates iterables that cannot be sliced, like generators, by
+    skipping to the page with islice. Only the objects of the page and
+    one lookahead object are held in memory. The count and number of
+    pages are None unless the iterable has a length.
+
+    """
+
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.count = known_length(object_list)
+        self.num_pages = None
+        if self.count is not None:
+            self.num_pages = max(1, -(-self.count // self.per_page))
+
+    def validate_number(self, number):
+        """Validates the page number, limiting it to the last page when
+        the number of pages is known.
+
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            number = 1
+        if self.num_pages is not None and number > self.num_pages:
+            number = self.num_pages
+        return number
+
+    def page(self, number):
+        """Returns the page for the number, consuming the iterable up to
+        the lookahead object after the page.
+
+        """
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if self.count is not None:
+            # no lookahead needed when the length is known
+            objects = list(itertools.islice(self.object_list, bottom, top))
+            return IterablePage(objects, number, self, top < self.count)
+        objects = list(itertools.islice(self.object_list, bottom, top + 1))
+        more = len(objects) > self.per_page
+        return IterablePage(objects[:self.per_page], number, self, more)
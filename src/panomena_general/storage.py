@@ -0,0 +1,37 @@
+import os
+
+from django.core.files.storage import FileSystemStorage
+
+from panomena_general.utils import hashed_filename, sharded_path
+
+
+class ContentHashedStorage(object):
+    """Storage mixin that names files after the sha1 hash of their
+    content, in a sharded layout under the directory given by upload_to.
+    A file with the same content that is already stored is reused
+    instead of saved again.
+
+    """
+
+    hash_length = 40
+    shard_depth = 2
+    shard_width = 2
+
+    def save(self, name, content):
+        if name is None:
+            name = content.name
+        directory, filename = os.path.split(name)
+        extention = os.path.splitext(filename)[1][1:].lower() or None
+        # name the file after its content
+        hashed = hashed_filename(content, extention, self.hash_length)
+        name = os.path.join(directory, sharded_path(hashed,
+            self.shard_depth, self.shard_width))
+        if self.exists(name):
+            return name
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        return super(ContentHashedStorage, self).save(name, content)
+
+
+class HashedFileSystemStorage(ContentHashedStorage, FileSystemStorage):
+    """File system storage that deduplicates files by content."""
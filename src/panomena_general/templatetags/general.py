@@ -1,16 +1,24 @@
+import re
 import urlparse
 import urllib
+import hashlib
 
 from django import template
 from django.conf import settings
-from django.template import Library, TemplateSyntaxError
-from django.template.loader import render_to_string
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.core.urlresolvers import reverse
-from django.contrib.contenttypes.models import ContentType
-
+from django.template import Library, Context, TemplateSyntaxError
+from django.template.loader import get_template
+from django.core.paginator import InvalidPage, EmptyPage
+from django.utils.encoding import smart_str
+
+from panomena_general import url_builders, instrumentation
+from panomena_general.utils import ArgSpec, cached_setting, MISSING, \
+    leaf_class, leaf_classes
+from panomena_general.content_types import content_types
 from panomena_general.exceptions import RequestContextRequiredException
 
+# the paginators and the cache are imported when first rendered so
+# loading the tag library stays cheap
+
 
 register = Library()
 
@@ -18,14 +26,22 @@ register = Library()
 class PagingNode(template.Node):
     """Tag node for rendering a pagination control using the template
     indicated and supplying only the list of objects, request key and
-    the size of the pages.
+    the size of the pages. When an ordering is supplied the objects are
+    paged by keyset using an opaque cursor instead of a page number.
+    Counting options are passed on to the CountingPaginator and the
+    loading options shape the query of the page only. Iterables that
+    cannot be sliced, like generators, are read up to the page only.
 
     """
 
-    def __init__(self, objects, key, size):
+    def __init__(self, objects, key, size, order_by=None,
+                 count_options=None, shape=None):
         self.objects = objects
         self.key = key
         self.size = size
+        self.order_by = order_by
+        self.count_options = count_options or {}
+        self.shape = shape or {}
 
     def render(self, context):
         # resolve variables
@@ -36,11 +52,23 @@ class PagingNode(template.Node):
         request = context.get('request')
         if request is None:
             raise RequestContextRequiredException('paging tag')
+        # page by cursor when an ordering was given
+        if self.order_by:
+            context[key] = self.keyset_page(request, objects, key, size)
+            return ''
         # get the page number
         try: page = int(request.GET.get(key, '1'))
         except ValueError: page = 1
+        # page iterables that cannot be sliced without reading them all
+        from panomena_general.paginator import is_sliceable, \
+            IterablePaginator
+        if not is_sliceable(objects):
+            context[key] = IterablePaginator(objects, size).page(page)
+            return ''
         # create the paginator
-        paginator = Paginator(objects, size)
+        from panomena_general.paginator import CountingPaginator
+        paginator = CountingPaginator(objects, size, shape=self.shape,
+            **self.count_options)
         # set the page
         try:
             page = paginator.page(page)
@@ -50,28 +78,131 @@ class PagingNode(template.Node):
         # return nothing to render
         return ''
 
+    def keyset_page(self, request, objects, key, size):
+        """Returns the keyset page for the cursor in the request."""
+        from panomena_general.paginator import KeysetPaginator
+        paginator = KeysetPaginator(objects, size, self.order_by,
+            self.shape)
+        try:
+            return paginator.page(request.GET.get(key))
+        except InvalidPage:
+            return paginator.page()
+
+
+ORDER_BY_RE = re.compile(r'^-?\w+(,-?\w+)*$')
+
+
+def ordering(value):
+    """Validates an ordering argument, stripping any quotes. Fields of
+    related models can't be used to page by keyset.
+
+    """
+    value = value.strip('"\'')
+    if ORDER_BY_RE.match(value) is None:
+        raise ValueError('not a comma separated list of fields')
+    if '__' in value:
+        raise ValueError('fields of related models are not supported')
+    return value
+
+
+FIELD_NAMES_RE = re.compile(r'^\w+(,\w+)*$')
+
+
+def field_names(value):
+    """Validates a comma separated list of field names, stripping any
+    quotes, and returns the names.
+
+    """
+    value = value.strip('"\'')
+    if FIELD_NAMES_RE.match(value) is None:
+        raise ValueError('not a comma separated list of fields')
+    return tuple(value.split(','))
+
+
+def values_mode(value):
+    """Validates the values option, which is true for all the fields
+    or a list of the fields to return.
+
+    """
+    if value.strip('"\'').lower() in ('1', 'true'):
+        return ()
+    return field_names(value)
+
+
+# options shaping the query of the page and not the count
+SHAPE_OPTIONS = ('select_related', 'prefetch_related', 'only', 'values')
+
+paging_spec = ArgSpec('paging', args=('objects', 'key', 'size'), kwargs={
+    'order_by': ordering,
+    'count_timeout': int,
+    'count_invalidate': lambda v: v.lower() in ('1', 'true'),
+    'count_estimate': int,
+    'count_cap': int,
+    'select_related': field_names,
+    'prefetch_related': field_names,
+    'only': field_names,
+    'values': values_mode,
+}, restrict=True)
+
 
 @register.tag
 def paging(parser, token):
     """Parser for the PagingNode tag node."""
     bits = token.split_contents()
-    if len(bits) < 4:
-        raise TemplateSyntaxError('%r takes at least 3 arguments' % bits[0])
-    objects = parser.compile_filter(bits[1])
-    key = parser.compile_filter(bits[2])
-    size = parser.compile_filter(bits[3])
-    return PagingNode(objects, key, size)
+    args, options, asvar = paging_spec.parse(parser, bits[1:])
+    objects, key, size = args
+    order_by = options.pop('order_by', None)
+    shape = dict([(name, options.pop(name)) for name in SHAPE_OPTIONS
+        if name in options])
+    # strip the prefix from the counting options
+    count_options = dict([(name[6:], value) for name, value
+        in options.items()])
+    return PagingNode(objects, key, size, order_by, count_options, shape)
 
 
 class PagingRenderNode(template.Node):
-    """Tag node for rendering paging controls."""
+    """Tag node for rendering paging controls. The rendered controls
+    are cached for the request, so repeated controls for the same page
+    render once, and optionally across requests for a timeout.
+
+    """
 
-    def __init__(self, page, key, label, template, url):
+    def __init__(self, page, key, label, template, url, timeout=None):
         self.page = page
         self.label = label
         self.key = key
         self.template = template
         self.url = url
+        self.timeout = timeout
+        self.templates = {}
+
+    def get_template(self, name):
+        """Returns the compiled template, loading it only once."""
+        compiled = self.templates.get(name)
+        if compiled is None:
+            compiled = get_template(name)
+            self.templates[name] = compiled
+        return compiled
+
+    def base_url(self, request, url, key):
+        """Strips the key from the url query string and prepares it for
+        a page value to be appended, once per request.
+
+        """
+        urls = request.__dict__.setdefault('_paging_urls', {})
+        cache_key = (url, key)
+        if cache_key not in urls:
+            # parse the url and query string
+            parsed = urlparse.urlparse(url)
+            qs = dict(urlparse.parse_qsl(parsed.query))
+            # remove the key from the query string
+            qs.pop(key, None)
+            parsed = parsed._replace(query=urllib.urlencode(qs))
+            base = urlparse.urlunparse(parsed)
+            # add the neccecary to the url
+            base += '?' if len(qs) == 0 else '&'
+            urls[cache_key] = base
+        return urls[cache_key]
 
     def render(self, context):
         # resolve variables
@@ -87,41 +218,59 @@ class PagingRenderNode(template.Node):
         # determine the url
         if not url:
             url = context['request'].get_full_path()
-        # parse the url and query string
-        url = urlparse.urlparse(url)
-        qs = dict(urlparse.parse_qsl(url.query))
-        # remove the key from the query string
-        qs.pop(key, None)
-        url = url._replace(query=urllib.urlencode(qs))
-        url = urlparse.urlunparse(url)
-        # add the neccecary to the url
-        url += '?' if len(qs) == 0 else '&' 
-        # render the template if supplied
-        return render_to_string(template, {
+        url = self.base_url(request, url, key)
+        # use the controls already rendered for this page
+        paginator = page.paginator
+        fragment_key = (template, page.number, paginator.num_pages,
+            getattr(paginator, 'count', None), page.has_next(),
+            getattr(page, 'next_cursor', None),
+            getattr(page, 'previous_cursor', None),
+            unicode(label), key, url)
+        fragments = request.__dict__.setdefault('_paging_fragments', {})
+        if fragment_key in fragments:
+            instrumentation.cache_hit()
+            return fragments[fragment_key]
+        if self.timeout:
+            from django.core.cache import cache
+            cache_key = 'panomena_general.paging_render.%s' % \
+                hashlib.md5(repr(fragment_key)).hexdigest()
+            output = cache.get(cache_key)
+            if output is not None:
+                instrumentation.cache_hit()
+                fragments[fragment_key] = output
+                return output
+        # render the template
+        output = self.get_template(template).render(Context({
             'page': page,
             'label': label,
             'key': key,
             'url': url
-        })
+        }))
+        fragments[fragment_key] = output
+        if self.timeout:
+            cache.set(cache_key, output, self.timeout)
+        return output
+
+
+paging_render_spec = ArgSpec('paging_render',
+    args=('page', 'key', 'label', 'template'), optional=('url',),
+    kwargs={'cache': int}, restrict=True)
 
 
 @register.tag
 def paging_render(parser, token):
     """Parser for the PagingRenderNode tag node."""
     bits = token.split_contents()
-    if len(bits) < 5:
-        raise TemplateSyntaxError('%r takes at least 4 arguments' % bits[0])
-    page = parser.compile_filter(bits[1])
-    key = parser.compile_filter(bits[2])
-    label = parser.compile_filter(bits[3])
-    template = parser.compile_filter(bits[4])
-    url = parser.compile_filter(bits[5] if len(bits) > 5 else '')
-    return PagingRenderNode(page, key, label, template, url)
+    args, options, asvar = paging_render_spec.parse(parser, bits[1:])
+    page, key, label, template, url = args
+    if url is None: url = parser.compile_filter('')
+    timeout = options.get('cache')
+    return PagingRenderNode(page, key, label, template, url, timeout)
 
 
 class IfHereNode(template.Node):
     """Tag node for rendering content if the current path starts
-    with the url to the specified view.
+    with the url to the specified view. Reversed urls are cached.
     
     """
     def __init__(self, view, args, nodelist):
@@ -131,8 +280,9 @@ class IfHereNode(template.Node):
 
     def render(self, context):
         args = [arg.resolve(context) for arg in self.args]
-        path = context['request'].path
-        if path.startswith(reverse(self.view, args=args)):
+        request = context['request']
+        url = url_builders.cached_reverse(self.view, args=args)
+        if request.path.startswith(url):
             return self.nodelist.render(context)
         else:
             return ''
@@ -157,11 +307,20 @@ def verbose_name_plural(obj):
     """Returns the plural verbose name of the object."""
     # change to leaf class for model base objects
     if hasattr(obj, 'as_leaf_class'):
-        obj = obj.as_leaf_class()
+        obj = leaf_class(obj)
     # return the name
     return obj._meta.verbose_name_plural.title()
 
 
+@register.filter(name='leaf_classes')
+def leaf_classes_filter(objects, field='content_type'):
+    """Resolves a list of model base objects to their leaf classes with
+    a query per leaf model, for use before looping over them.
+
+    """
+    return leaf_classes(objects, field)
+
+
 class URLNextNode(template.defaulttags.URLNode):
     """Tag that works like regular url tag but includes 'next' get parameter
     when it picks it up in the request.
@@ -176,18 +335,51 @@ class URLNextNode(template.defaulttags.URLNode):
             urlnode.asvar
         )
 
-    def render(self, context):
+    def url_tag(self, context):
+        """Reverses the url with the url tag, returning it even when it
+        is assigned to a variable.
+
+        """
         url = super(URLNextNode, self).render(context)
+        if self.asvar:
+            url = context[self.asvar]
+        return url
+
+    def reverse(self, context):
+        """Reverses the url with the cached reversal, leaving urls for
+        a current app and failed reversals to the url tag.
+
+        """
+        if getattr(context, 'current_app', None):
+            return self.url_tag(context)
+        view_name = self.view_name
+        if hasattr(view_name, 'resolve'):
+            view_name = view_name.resolve(context)
+        args = [arg.resolve(context) for arg in self.args]
+        kwargs = dict([(smart_str(k, 'ascii'), v.resolve(context))
+            for k, v in self.kwargs.items()])
+        from django.core.urlresolvers import NoReverseMatch
+        try:
+            return url_builders.cached_reverse(view_name, args=args,
+                kwargs=kwargs)
+        except NoReverseMatch:
+            return self.url_tag(context)
+
+    def render(self, context):
+        url = self.reverse(context)
         # attempt to get the request
         request = context.get('request')
         if request is None:
             raise RequestContextRequiredException('url_next tag')
         # check for and add next url
         next_url = request.GET.get('next')
-        if next_url:
+        if next_url and url:
             url += '&' if '?' in url else '?'
             url += 'next=%s' % next_url
-        # return the modified url
+        # assign or return the modified url
+        if self.asvar:
+            context[self.asvar] = url
+            return ''
         return url
 
         
@@ -198,8 +390,37 @@ def url_next(parser, token):
     return URLNextNode(urlnode)
 
 
+def smart_url_memo(context):
+    """Returns the memo of object urls for the request, or for the
+    template render when there is no request.
+
+    """
+    request = context.get('request')
+    if request is not None:
+        return request.__dict__.setdefault('_smart_urls', {})
+    render_context = context.render_context
+    if '_smart_urls' not in render_context:
+        render_context['_smart_urls'] = {}
+    return render_context['_smart_urls']
+
+
+def smart_url_key(url_callable, obj):
+    """Returns the key of an object url in the memo, or None for
+    objects without a primary key, which are not remembered.
+
+    """
+    pk = getattr(obj, 'pk', None)
+    if pk is not None:
+        return (url_callable, obj.__class__, pk)
+    return None
+
+
 class SmartURLNode(template.Node):
-    """Tag that pcks up the url of an object using a callable."""
+    """Tag that pcks up the url of an object using a callable. Urls are
+    remembered for the request, including those built in bulk by the
+    smart_urls tag.
+
+    """
 
     def __init__(self, url_callable, obj, asvar):
         self.url_callable = url_callable
@@ -212,7 +433,14 @@ class SmartURLNode(template.Node):
         obj = self.obj.resolve(context)
         asvar = self.asvar
         # determine the url and return or assign
-        url = url_callable(obj)
+        memo = smart_url_memo(context)
+        key = smart_url_key(url_callable, obj)
+        url = memo.get(key) if key is not None else None
+        if url is None:
+            url = url_callable(obj)
+            if key is not None: memo[key] = url
+        else:
+            instrumentation.cache_hit()
         if asvar is None:
             return url
         else:
@@ -228,6 +456,7 @@ def new_smart_url(parser, token):
     if len(bits) < 3:
         raise TemplateSyntaxError('%r takes at least 2 arguments' % bits[0])
     # determine var name if given
+    asvar = None
     if len(bits) >= 2 and bits[-2] == 'as':
         asvar = bits[-1]
         bits = bits[:-2]
@@ -238,6 +467,65 @@ def new_smart_url(parser, token):
     return SmartURLNode(url_callable, obj, asvar)
 
 
+class SmartURLsNode(template.Node):
+    """Tag node that builds the urls of a list of objects in one call,
+    using the many method of the url callable when it has one. The
+    urls are remembered for the new_smart_url tag and can be assigned
+    as a mapping of object to url.
+
+    """
+
+    def __init__(self, url_callable, objects, asvar):
+        self.url_callable = url_callable
+        self.objects = objects
+        self.asvar = asvar
+
+    def render(self, context):
+        # resolve variables
+        url_callable = self.url_callable.resolve(context)
+        objects = list(self.objects.resolve(context))
+        # only build the urls not yet remembered
+        memo = smart_url_memo(context)
+        keys = [smart_url_key(url_callable, obj) for obj in objects]
+        urls = [memo.get(key) if key is not None else None
+            for key in keys]
+        missing = [i for i, url in enumerate(urls) if url is None]
+        if missing:
+            missing_objects = [objects[i] for i in missing]
+            many = getattr(url_callable, 'many', None)
+            if many is None:
+                built = [url_callable(obj) for obj in missing_objects]
+            else:
+                built = many(missing_objects)
+                if isinstance(built, dict):
+                    built = [built[obj] for obj in missing_objects]
+            for i, url in zip(missing, built):
+                urls[i] = url
+                if keys[i] is not None: memo[keys[i]] = url
+        # assign the mapping if requested
+        if self.asvar is not None:
+            context[self.asvar] = dict(zip(objects, urls))
+        return ''
+
+
+@register.tag
+def smart_urls(parser, token):
+    """Parser method for the SmartURLsNode tag node."""
+    bits = token.split_contents()
+    # determine var name if given
+    asvar = None
+    if len(bits) >= 2 and bits[-2] == 'as':
+        asvar = bits[-1]
+        bits = bits[:-2]
+    # check for right amount of parameters
+    if len(bits) != 3:
+        raise TemplateSyntaxError('%r takes 2 arguments' % bits[0])
+    url_callable = parser.compile_filter(bits[1])
+    objects = parser.compile_filter(bits[2])
+    # build and return the node
+    return SmartURLsNode(url_callable, objects, asvar)
+
+
 class ContentTypeNode(template.Node):
     """Tag node for retrieving content type of an object."""
 
@@ -249,7 +537,7 @@ class ContentTypeNode(template.Node):
         # resolve the arguments
         obj = self.obj.resolve(context)
         # get the content type
-        content_type = ContentType.objects.get_for_model(obj)
+        content_type = content_types.get_for_model(obj)
         # set variable in context
         context[self.asvar] = content_type
         return ''
@@ -273,18 +561,78 @@ def content_type(parser, token):
     return ContentTypeNode(obj, asvar)
  
 
-@register.simple_tag
-def setting(key):
-    """Returns the value of setting."""
-    return getattr(settings, key)
+class SettingNode(template.Node):
+    """Tag node for rendering the value of a setting, read from the
+    settings snapshot.
+
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def render(self, context):
+        key = self.key
+        if not isinstance(key, basestring):
+            key = key.resolve(context)
+        value = cached_setting(key, MISSING)
+        if value is MISSING:
+            return getattr(settings, key)
+        return value
+
+
+@register.tag
+def setting(parser, token):
+    """Parser function for building a SettingNode. Literal keys are
+    read into the settings snapshot when the template is compiled.
+
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise TemplateSyntaxError('%r takes a single argument' % bits[0])
+    key = parser.compile_filter(bits[1])
+    if isinstance(key.var, basestring) and not key.filters:
+        key = unicode(key.var)
+        cached_setting(key)
+    return SettingNode(key)
 
 
 @register.simple_tag
 def content_object_url(view, obj):
     """Builds a url for a content object to a specified view."""
-    content_type = ContentType.objects.get_for_model(obj)
-    content_type = '.'.join([content_type.app_label, content_type.model])
-    return reverse(view, kwargs={
-        'object_id': obj.id,
-        'content_type': content_type,
-    })
+    return url_builders.content_object_url(view, obj)
+
+
+class ContentObjectURLsNode(template.Node):
+    """Tag node for building the urls of a list of content objects to a
+    specified view in one call.
+
+    """
+
+    def __init__(self, view, objects, asvar):
+        self.view = view
+        self.objects = objects
+        self.asvar = asvar
+
+    def render(self, context):
+        # resolve the arguments
+        view = self.view.resolve(context)
+        objects = self.objects.resolve(context)
+        # build the (object, url) pairs
+        context[self.asvar] = url_builders.content_object_urls(view, objects)
+        return ''
+
+
+@register.tag
+def content_object_urls(parser, token):
+    """Parser function for building a ContentObjectURLsNode."""
+    bits = token.split_contents()
+    # check for the right amount of arguments
+    if len(bits) != 5 or bits[-2] != 'as':
+        raise TemplateSyntaxError('%r takes a view, a list of objects and ' \
+            'a variable name to be assigned to' % bits[0])
+    asvar = bits[-1]
+    # parse the rest of the arguments
+    view = parser.compile_filter(bits[1])
+    objects = parser.compile_filter(bits[2])
+    # build and return the node
+    return ContentObjectURLsNode(view, objects, asvar)
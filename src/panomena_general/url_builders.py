@@ -0,0 +1,154 @@
+from django.utils.encoding import force_unicode
+from django.utils.translation import get_language
+
+from panomena_general import instrumentation
+from panomena_general.content_types import content_types
+
+
+# placeholder id reversed into urls and replaced when building them
+PLACEHOLDER_ID = 987654321
+
+# amount of reversed urls kept before the cache is cleared
+REVERSE_CACHE_SIZE = 1000
+
+_builders = {}
+_reversals = {}
+
+
+def _resolver():
+    # the url resolvers are imported when used so loading this module,
+    # and the tag library using it, stays cheap
+    from django.core.urlresolvers import get_resolver, get_urlconf
+    return get_resolver(get_urlconf())
+
+
+def cached_reverse(view, args=None, kwargs=None):
+    """Works like reverse but remembers the urls it has built until the
+    url configuration changes. Urls are kept per script prefix and
+    language, as translated url patterns reverse differently.
+
+    """
+    from django.core.urlresolvers import reverse, get_script_prefix
+    resolver = _resolver()
+    key = (view, get_script_prefix(), get_language(),
+        tuple([force_unicode(arg) for arg in args or ()]),
+        tuple(sorted([(name, force_unicode(value)) for name, value
+            in (kwargs or {}).items()])))
+    cached = _reversals.get(key)
+    if cached is not None and cached[0] is resolver:
+        instrumentation.cache_hit()
+        return cached[1]
+    url = reverse(view, args=args, kwargs=kwargs)
+    if len(_reversals) >= REVERSE_CACHE_SIZE:
+        _reversals.clear()
+    _reversals[key] = (resolver, url)
+    return url
+
+
+def export_reversals():
+    """Returns the reversed urls for the current url configuration as a
+    list of (view, script prefix, language, args, kwargs, url) tuples.
+
+    """
+    resolver = _resolver()
+    return [key + (url,) for key, (cached_resolver, url)
+        in _reversals.items() if cached_resolver is resolver]
+
+
+def import_reversals(reversals):
+    """Adds reversed urls, as returned by export_reversals, for the
+    current url configuration.
+
+    """
+    resolver = _resolver()
+    for view, prefix, language, args, kwargs, url in reversals:
+        key = (view, prefix, language, tuple(args),
+            tuple([tuple(item) for item in kwargs]))
+        _reversals[key] = (resolver, url)
+
+
+def export_builders():
+    """Returns the compiled urls for the current url configuration as a
+    list of (view, content type, script prefix, language, parts) tuples.
+
+    """
+    resolver = _resolver()
+    return [key + (parts,) for key, (cached_resolver, parts)
+        in _builders.items() if cached_resolver is resolver]
+
+
+def import_builders(builders):
+    """Adds compiled urls, as returned by export_builders, for the
+    current url configuration.
+
+    """
+    resolver = _resolver()
+    for view, content_type, prefix, language, parts in builders:
+        if parts is not None: parts = tuple(parts)
+        _builders[(view, content_type, prefix, language)] = \
+            (resolver, parts)
+
+
+def compile_url(view, content_type):
+    """Reverses the url of a view for a content type once using a
+    placeholder id, returning the text before and after the id or None
+    when the url can't be built by substitution.
+
+    """
+    from django.core.urlresolvers import reverse, NoReverseMatch
+    try:
+        url = reverse(view, kwargs={
+            'object_id': PLACEHOLDER_ID,
+            'content_type': content_type,
+        })
+    except NoReverseMatch:
+        return None
+    parts = url.split(str(PLACEHOLDER_ID))
+    if len(parts) != 2:
+        return None
+    return tuple(parts)
+
+
+def get_url_builder(view, content_type):
+    """Returns the compiled url for a view and content type, compiling
+    it again when the url configuration has changed.
+
+    """
+    from django.core.urlresolvers import get_script_prefix
+    resolver = _resolver()
+    key = (view, content_type, get_script_prefix(), get_language())
+    cached = _builders.get(key)
+    if cached is None or cached[0] is not resolver:
+        cached = (resolver, compile_url(view, content_type))
+        _builders[key] = cached
+    else:
+        instrumentation.cache_hit()
+    return cached[1]
+
+
+def clear_url_builders():
+    """Clears all the compiled and reversed urls."""
+    _builders.clear()
+    _reversals.clear()
+
+
+def content_object_url(view, obj):
+    """Builds a url for a content object to a specified view."""
+    content_type = content_types.get_for_model(obj)
+    content_type = '.'.join([content_type.app_label, content_type.model])
+    builder = get_url_builder(view, content_type)
+    if builder is None or not isinstance(obj.id, (int, long)):
+        from django.core.urlresolvers import reverse
+        return reverse(view, kwargs={
+            'object_id': obj.id,
+            'content_type': content_type,
+        })
+    return '%s%d%s' % (builder[0], obj.id, builder[1])
+
+
+def content_object_urls(view, objects):
+    """Builds the urls for a list of content objects to a specified
+    view, returning a list of (object, url) tuples.
+
+    """
+    return [(obj, content_object_url(view, obj)) for obj in objects]
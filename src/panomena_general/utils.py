@@ -1,18 +1,38 @@
+import os
 import re
+import copy
 import json
 import base64
-import random
+import hmac
+import string
+import hashlib
 import functools
+import itertools
+import threading
+from collections import OrderedDict
 
-from django import template
 from django.conf import settings
-from django.http import HttpResponse
-from django.shortcuts import redirect
+from django.core import signals
+from django.utils.crypto import constant_time_compare
+from django.utils.datastructures import SortedDict
 from django.core.exceptions import ImproperlyConfigured
-from django.contrib.contenttypes.models import ContentType
 
+from panomena_general.content_types import content_types
 from panomena_general.exceptions import InvalidContentTypeException
 
+try:
+    import simplejson as fast_json
+except ImportError:
+    fast_json = json
+
+# http, models, serializers and templates are imported where they are
+# used to keep importing this module cheap
+
+
+def _syntax_error(message):
+    from django.template import TemplateSyntaxError
+    return TemplateSyntaxError(message)
+
 
 CONTENT_TYPE_RE = re.compile(r'^([^.]+).([^.]+)$')
 
@@ -23,52 +43,351 @@ def get_content_type(content_type):
     if match is None:
         raise InvalidContentTypeException()
     content_type = content_type.split('.')
-    return ContentType.objects.get_by_natural_key(*content_type)
+    return content_types.get_by_natural_key(*content_type)
+
+
+# amount of random bytes drawn from the system at a time
+RANDOM_BATCH_SIZE = 4096
+
+BASE32_ALPHABET = 'abcdefghijklmnopqrstuvwxyz234567'
+
+# random bytes left over and the filename counter of the process
+_random_state = {}
+_random_lock = threading.Lock()
+
 
+def _random_name(length):
+    """Returns random base32 text of the given length and the next
+    sequence number of the process. Both are reset when the process id
+    changes so forked workers don't repeat the names of their parent.
 
-def generate_filename(extention=None):
-    """Generates a random filename."""
-    elements = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ123456890'
-    name = ''.join([random.choice(elements) for n in range(8)])
+    """
+    # base32 gives 5 bits per character, so draw enough whole groups
+    size = (length * 5 + 39) // 40 * 5
+    with _random_lock:
+        pid = os.getpid()
+        if _random_state.get('pid') != pid:
+            _random_state.update(pid=pid, buffer='',
+                counter=itertools.count())
+        buf = _random_state['buffer']
+        if len(buf) < size:
+            buf = os.urandom(max(RANDOM_BATCH_SIZE, size))
+        _random_state['buffer'] = buf[size:]
+        number = next(_random_state['counter'])
+    return base64.b32encode(buf[:size])[:length].lower(), number
+
+
+def _base32(number):
+    digits = []
+    while True:
+        number, digit = divmod(number, 32)
+        digits.append(BASE32_ALPHABET[digit])
+        if not number: break
+    return ''.join(reversed(digits))
+
+
+def generate_filename(extention=None, length=8):
+    """Generates a filename of random characters from secure random
+    bytes, followed by a per process sequence number so it is unique
+    within the process.
+
+    """
+    name, number = _random_name(length)
+    name += _base32(number)
     if extention: return '%s.%s' % (name, extention)
     else: return name
 
 
+def hashed_filename(content, extention=None, length=40):
+    """Generates a filename from the sha1 hash of file content, so
+    identical uploads are given the same name.
+
+    """
+    digest = hashlib.sha1()
+    if hasattr(content, 'chunks'):
+        for chunk in content.chunks():
+            digest.update(chunk)
+    else:
+        digest.update(content)
+    name = digest.hexdigest()[:length]
+    if extention: return '%s.%s' % (name, extention)
+    else: return name
+
+
+def sharded_path(name, depth=2, width=2):
+    """Prefixes a filename with directories made from its first
+    characters, like 'ab/cd/abcdef.jpg'.
+
+    """
+    shards = [name[n * width:(n + 1) * width] for n in range(depth)]
+    return '/'.join(shards + [name])
+
+
+class UploadTo(object):
+    """Callable for the upload_to argument of file fields that stores
+    uploads under a directory with random names in a sharded directory
+    layout. With hashed the original name is kept for a
+    ContentHashedStorage to replace with the hash of the content.
+
+    """
+
+    def __init__(self, path='', hashed=False, length=None, depth=2,
+                 width=2):
+        self.path = path
+        self.hashed = hashed
+        self.length = length
+        self.depth = depth
+        self.width = width
+
+    def __call__(self, instance, filename):
+        if self.hashed:
+            name = filename
+        else:
+            extention = os.path.splitext(filename)[1][1:].lower() or None
+            name = generate_filename(extention, self.length or 8)
+            name = sharded_path(name, self.depth, self.width)
+        return os.path.join(self.path, name) if self.path else name
+
+
 def is_ajax_request(request):
     """Determines if a request was an AJAX request."""
     return request.META.get('HTTP_X_REQUESTED_WITH', '') == 'XMLHttpRequest'
 
 
-def json_response(data):
-    """Build a response object for json data."""
-    return HttpResponse(
-        json.dumps(data),
+# amount of serialized json payloads kept by version key
+JSON_PAYLOAD_CACHE_SIZE = 128
+
+_json_payloads = OrderedDict()
+_json_payloads_lock = threading.Lock()
+
+
+def _json_payload(key, build, etag):
+    """Returns the serialized payload and its etag, reading both from the
+    payload cache when a key is given and building the payload once.
+
+    """
+    if key is not None:
+        with _json_payloads_lock:
+            cached = _json_payloads.pop(key, None)
+            if cached is not None:
+                _json_payloads[key] = cached
+                return cached
+    content = build()
+    tag = '"%s"' % hashlib.sha1(content).hexdigest() \
+        if etag or key is not None else None
+    if key is not None:
+        with _json_payloads_lock:
+            _json_payloads[key] = (content, tag)
+            while len(_json_payloads) > JSON_PAYLOAD_CACHE_SIZE:
+                _json_payloads.popitem(last=False)
+    return content, tag
+
+
+def clear_json_payloads():
+    """Clears the cache of serialized json payloads."""
+    with _json_payloads_lock:
+        _json_payloads.clear()
+
+
+def _etag_matches(request, etag):
+    """Determines if the If-None-Match header of a GET or HEAD request
+    matches the etag.
+
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'): tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+def _json_http_response(content, tag, mimetype, request, etag,
+                        cache_control):
+    """Builds the response for a serialized payload, answering with a
+    304 when the request already has it.
+
+    """
+    from django.http import HttpResponse, HttpResponseNotModified
+    from django.utils.cache import patch_cache_control
+    if etag and request is not None and _etag_matches(request, tag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, mimetype=mimetype)
+    if etag:
+        response['ETag'] = tag
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
+
+
+def json_response(data, request=None, etag=False, cache_key=None,
+                  version=None, cache_control=None):
+    """Build a response object for json data.
+
+    Params:
+    * request : the request, to answer with a 304 when its If-None-Match
+      header matches the etag
+    * etag : adds a strong etag computed from the payload
+    * cache_key : key the serialized payload is cached under, which must
+      be unique to the view and data, like the url of the view
+    * version : version of the data cached under the key, the caller
+      changing it whenever the data changes, required with a cache_key
+    * cache_control : keyword arguments for the Cache-Control header
+
+    """
+    if (version is None) != (cache_key is None):
+        raise ValueError('A cache_key and version are required together '
+            'to cache the payload.')
+    key = ('json', cache_key, version) if cache_key is not None else None
+    content, tag = _json_payload(key, lambda: json.dumps(data), etag)
+    return _json_http_response(content, tag, 'application/json', request,
+        etag, cache_control)
+
+
+def _json_default(obj):
+    from django.core.serializers.json import DjangoJSONEncoder
+    return DjangoJSONEncoder().default(obj)
+
+
+def json_dumps(data):
+    """Compact json encoder used for streaming, using simplejson when
+    installed and the standard library otherwise.
+
+    """
+    return fast_json.dumps(data, default=_json_default,
+        separators=(',', ':'))
+
+
+def iter_json(data, dumps=json_dumps, chunk_size=100):
+    """Yields json for data in chunks. Querysets, iterables and
+    generators are encoded as arrays one item at a time, with querysets
+    iterated as dictionaries so no model instances are built.
+
+    """
+    from django.db.models.query import QuerySet
+    try:
+        from django.db.models.query import ValuesQuerySet
+    except ImportError:
+        ValuesQuerySet = None
+    if isinstance(data, QuerySet):
+        if ValuesQuerySet is None or not isinstance(data, ValuesQuerySet):
+            data = data.values()
+        data = data.iterator()
+    elif isinstance(data, (basestring, dict)) or \
+        not hasattr(data, '__iter__'):
+        yield dumps(data)
+        return
+    # encode the items in chunks
+    chunk, first = ['['], True
+    for item in data:
+        if not first: chunk.append(',')
+        first = False
+        chunk.append(dumps(item))
+        if len(chunk) >= chunk_size * 2:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def streaming_json_response(data, dumps=json_dumps, chunk_size=100):
+    """Build a response object that streams json data in chunks."""
+    try:
+        from django.http import StreamingHttpResponse
+    except ImportError:
+        # older versions of django stream iterators given to HttpResponse
+        from django.http import HttpResponse as StreamingHttpResponse
+    return StreamingHttpResponse(
+        iter_json(data, dumps, chunk_size),
         mimetype='application/json'
     )
 
 
-def ajax_redirect(request, url):
-    """Redirects via a json response if ajax was used in the request."""
+def ajax_redirect(request, url, **kwargs):
+    """Redirects via a json response if ajax was used in the request.
+    Extra arguments are passed on to json_redirect.
+
+    """
+    from django.shortcuts import redirect
     ajax = is_ajax_request(request)
-    if ajax: response = json_redirect(url)
+    if ajax: response = json_redirect(url, request=request, **kwargs)
     else: response = redirect(url)
     return response
 
 
+# marks settings that are not defined in the snapshot
+MISSING = object()
+
+_settings = {}
+_settings_holder = [None]
+
+
+def cached_setting(name, default=None):
+    """Retrieve a setting from a snapshot of the project settings,
+    reading it from the settings only the first time. The snapshot is
+    cleared when the settings are swapped, as override_settings does.
+
+    """
+    holder = settings._wrapped
+    if holder is not _settings_holder[0]:
+        _settings.clear()
+        _settings_holder[0] = holder
+    setting = _settings.get(name, MISSING)
+    if setting is MISSING:
+        setting = getattr(settings, name, MISSING)
+        _settings[name] = setting
+    if setting is MISSING:
+        return default
+    return setting
+
+
+def clear_settings_cache(setting=None, **kwargs):
+    """Clears a setting, or all settings, from the snapshot."""
+    if setting is None: _settings.clear()
+    else: _settings.pop(setting, None)
+
+
+# newer versions of django signal changed settings outside of tests
+if hasattr(signals, 'setting_changed'):
+    signals.setting_changed.connect(clear_settings_cache,
+        dispatch_uid='panomena_general.utils.clear_settings_cache')
+
+
+def _required_message(names, app_name):
+    return 'The %s setting%s required for the %s application to ' \
+        'function.' % (', '.join(names),
+        ' is' if len(names) == 1 else 's are', app_name)
+
+
 class SettingsFetcher(object):
     """Retrieves settings from project settings throwing uniform errors
-    for the application.
+    for the application. Settings declared as required are validated
+    together when the fetcher is created.
         
     """
 
-    def __init__(self, app_name):
+    def __init__(self, app_name, required=()):
         self.app_name = app_name
+        if required: self.validate(required)
+
+    def validate(self, names):
+        """Raises a single error naming every missing setting."""
+        missing = [name for name in names if cached_setting(name) is None]
+        if missing:
+            raise ImproperlyConfigured(
+                _required_message(missing, self.app_name))
 
     def __getattr__(self, name):
-        setting = getattr(settings, name, None)
+        setting = cached_setting(name)
         if setting is None:
-            raise ImproperlyConfigured('The %s setting is required for the %s ' \
-                'application to function.' % (name, self.app_name))
+            raise ImproperlyConfigured(
+                _required_message([name], self.app_name))
         else:
             return setting
             
@@ -78,34 +397,219 @@ def get_setting(name, component_name, message=None):
     of failure if not defined.
     
     """
-    setting = getattr(settings, name, None)
+    setting = cached_setting(name)
     if setting is None:
         if message: raise ImproperlyConfigured(message)
-        raise ImproperlyConfigured('The %s setting is required for the %s ' \
-            'application to function.' % (name, component_name))
+        raise ImproperlyConfigured(
+            _required_message([name], component_name))
     return setting
 
 
-def class_from_string(path):
-    """Returns a class from a path string to the class."""
+_classes = {}
+_classes_lock = threading.RLock()
+
+
+def _import_class(path):
     path = path.split('.')
     imp = __import__('.'.join(path[:-1]), globals(), locals(), path[-1:])
     return getattr(imp, path[-1])
 
 
-def json_redirect(url, textarea=False):
-    """Creates an http response containing json with a redirect url."""
+def class_from_string(path):
+    """Returns a class from a path string to the class. Results, and
+    failures to import, are remembered for later calls.
+
+    """
+    result = _classes.get(path)
+    if result is None:
+        with _classes_lock:
+            result = _classes.get(path)
+            if result is None:
+                try:
+                    result = (True, _import_class(path))
+                except (ImportError, AttributeError, ValueError), e:
+                    result = (False, e)
+                _classes[path] = result
+    found, value = result
+    if not found: raise value
+    return value
+
+
+def preload_classes(paths):
+    """Resolves a list of class paths in one go, returning a mapping of
+    path to class and raising a single error naming all the paths
+    that failed.
+
+    """
+    classes, failed = {}, []
+    for path in paths:
+        try: classes[path] = class_from_string(path)
+        except (ImportError, AttributeError, ValueError), e:
+            failed.append('%s (%s)' % (path, e))
+    if failed:
+        raise ImproperlyConfigured('The following classes could not be ' \
+            'imported: %s' % ', '.join(failed))
+    return classes
+
+
+class LazyClass(object):
+    """Stands in for a class given by a path string, deferring the
+    import until the class is first used.
+
+    """
+
+    def __init__(self, path):
+        self.__dict__['_path'] = path
+
+    def resolve(self):
+        """Returns the class the path refers to."""
+        return class_from_string(self._path)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        return '<LazyClass %s>' % self._path
+
+
+def json_redirect(url, textarea=False, request=None, etag=False,
+                  version=None, cache_control=None):
+    """Creates an http response containing json with a redirect url. The
+    conditional arguments work as for json_response. As the payload only
+    depends on the url, it is cached under the url when a version is
+    given.
+
+    """
     response = {'redirect': url}
+    key = ('redirect', version, url, textarea) \
+        if version is not None else None
     if textarea:
-        return HttpResponse(
-            '<textarea>%s</textarea>' % json.dumps(response),
-            mimetype='text/html'
-        )
+        build = lambda: '<textarea>%s</textarea>' % json.dumps(response)
+        mimetype = 'text/html'
     else:
-        return HttpResponse(
-            json.dumps(response),
-            mimetype='application/json'
-        )
+        build = lambda: json.dumps(response)
+        mimetype = 'application/json'
+    content, tag = _json_payload(key, build, etag)
+    return _json_http_response(content, tag, mimetype, request, etag,
+        cache_control)
+
+
+KWARG_RE = re.compile(r'^(\w+)=(.*)$')
+
+
+class ArgSpec(object):
+    """Argument specification for template tags that is compiled once,
+    when the tag function is defined, and then parses the positional,
+    keyword and 'as var' arguments of each use of the tag.
+
+    Params:
+    * tagname : the name of the tag (for error messages)
+    * args : names of the required positional arguments
+    * optional : names of the optional positional arguments
+    * kwargs : (optional) dict of argname=>validator, as for parse_kw_args
+    * restrict : if True, only argnames in kwargs will be accepted
+    * asvar : if True, a trailing 'as var' is accepted
+
+    Values of keyword arguments with a callable validator become the
+    value returned by the validator, all other values are compiled
+    into filter expressions.
+    """
+
+    def __init__(self, tagname, args=(), optional=(), kwargs=None,
+                 restrict=False, asvar=False):
+        if restrict and kwargs is None:
+            raise ValueError("you must pass a kwargs dict if you want to " \
+                "restrict allowed args")
+        self.tagname = tagname
+        self.args = tuple(args)
+        self.optional = tuple(optional)
+        self.restrict = restrict
+        self.asvar = asvar
+        self.validators = {}
+        for name, validate in (kwargs or {}).items():
+            if validate is not None and not callable(validate):
+                validate = re.compile(validate)
+            self.validators[name] = validate
+        self.allowed = frozenset(self.validators)
+
+    def parse_keywords(self, bits):
+        """Parses and validates a sequence of key=value strings,
+        returning a list of (argname, value) tuples.
+
+        """
+        tagname = self.tagname
+        args, seen = [], set()
+        for bit in bits:
+            match = KWARG_RE.match(bit)
+            if match is None:
+                raise _syntax_error(
+                    "keyword arguments to '%s' tag must have 'key=value' " \
+                    "form (got : '%s')" % (tagname, bit))
+            name, val = match.groups()
+            name = str(name)
+            if self.restrict:
+                # we only want each name once
+                if name not in self.allowed or name in seen:
+                    raise _syntax_error(
+                        "keyword arguments to '%s' tag must be one of %s " \
+                        "(got : '%s')" % (tagname, ','.join(
+                        sorted(self.allowed - seen)), name))
+                seen.add(name)
+            validate = self.validators.get(name)
+            if validate is None:
+                pass
+            elif callable(validate):
+                try:
+                    val = validate(val)
+                except Exception, e:
+                    raise _syntax_error(
+                        "invalid optional argument '%s' for '%s' tag: " \
+                        "'%s' (%s)" % (name, tagname, val, e))
+            elif validate.match(val) is None:
+                raise _syntax_error(
+                    "invalid optional argument '%s' for '%s' tag: '%s' " \
+                    "(doesn't match '%s')" % (name, tagname, val,
+                    validate.pattern))
+            # should be ok if we managed to get here
+            args.append((name, val))
+        return args
+
+    def parse(self, parser, bits):
+        """Parses the bits following the tag name, returning the list of
+        positional arguments, a dict of keyword arguments and the name
+        of the variable to assign to.
+
+        """
+        tagname = self.tagname
+        bits = list(bits)
+        # determine var name if given
+        asvar = None
+        if self.asvar and len(bits) >= 2 and bits[-2] == 'as':
+            asvar = bits[-1]
+            bits = bits[:-2]
+        # separate the positional and keyword arguments
+        positional = []
+        while bits and KWARG_RE.match(bits[0]) is None:
+            positional.append(bits.pop(0))
+        count = len(self.args) + len(self.optional)
+        if len(positional) < len(self.args):
+            raise _syntax_error("'%s' takes at least %d " \
+                "arguments" % (tagname, len(self.args)))
+        if len(positional) > count:
+            raise _syntax_error("'%s' takes at most %d " \
+                "arguments" % (tagname, count))
+        args = [parser.compile_filter(bit) for bit in positional]
+        args += [None] * (count - len(args))
+        # compile the keyword arguments
+        kwargs = {}
+        for name, val in self.parse_keywords(bits):
+            if not callable(self.validators.get(name)):
+                val = parser.compile_filter(val)
+            kwargs[name] = val
+        return args, kwargs, asvar
 
 
 def parse_kw_args(tagname, bits, args_spec=None, restrict=False):
@@ -138,79 +642,215 @@ def parse_kw_args(tagname, bits, args_spec=None, restrict=False):
     to True. This is useful when the only validation is on the argument
     name being expected.
     """
-    
-    args = []
+    spec = ArgSpec(tagname, kwargs=args_spec, restrict=restrict)
+    return spec.parse_keywords(bits)
 
-    if restrict:
-        if args_spec is None:
-            raise ValueError("you must pass an args_spec dict if you want to restrict allowed args")        
-        allowed = list(args_spec.keys())
-        do_validate = True
-    else:
-        do_validate = args_spec is not None
-        
-    for bit in bits:
-        try:
-            name, val = bit.split('=')
-        except ValueError:
-            raise template.TemplateSyntaxError(
-                "keyword arguments to '%s' tag must have 'key=value' form (got : '%s')" \
-                % (tagname, bit)
-                )
-        
-        name = str(name)        
-        if do_validate:
-            if restrict:
-                if name in allowed:
-                    # we only want each name once
-                    del allowed[allowed.index(name)]
-                else:
-                    raise template.TemplateSyntaxError(
-                        "keyword arguments to '%s' tag must be one of % (got : '%s')" \
-                        % (tagname, ",".join(allowed), name)
-                        )
-
-                validate = args_spec[name]
-            else: 
-                validate = args_spec.get(name, None)
-                
-            if validate is not None:
-                if callable(validate):
-                    try:
-                        val = validate(val)
-                    except Exception, e:
-                        raise template.TemplateSyntaxError(
-                            "invalid optional argument '%s' for '%s' tag: '%s' (%s)" \
-                            % (tagname, name, val, e)
-                            )
-                else:
-                    # assume re
-                    if re.match(validate, val) is None:
-                        raise template.TemplateSyntaxError(
-                            "invalid optional argument '%s' for '%s' tag: '%s' (doesn't match '%s')" \
-                            % (tagname, name, val, validate)
-                        )
-                    
-        # should be ok if we managed to get here        
-        args.append((name, val))
-    
-    return args
 
+def leaf_class(obj):
+    """Returns the leaf class instance of a model base object, using the
+    instance resolved by leaf_classes when available.
+
+    """
+    leaf = obj.__dict__.get('_leaf_class')
+    if leaf is None:
+        leaf = obj.as_leaf_class()
+        obj._leaf_class = leaf
+    return leaf
+
+
+def leaf_classes(objects, field='content_type'):
+    """Resolves a list of model base objects to their leaf class
+    instances, fetching each leaf model with a single query. The
+    content type of each object is read from the named foreign key.
+
+    """
+    objects = list(objects)
+    # group the objects still to be resolved by leaf model
+    pending = {}
+    for obj in objects:
+        if not hasattr(obj, 'as_leaf_class') or \
+            '_leaf_class' in obj.__dict__:
+            continue
+        content_type_id = getattr(obj, '%s_id' % field, None)
+        if content_type_id is None: continue
+        model = content_types.get_for_id(content_type_id).model_class()
+        if model is None or isinstance(obj, model):
+            obj._leaf_class = obj
+        else:
+            pending.setdefault(model, []).append(obj)
+    # fetch the leaf instances with a query per model
+    for model, model_objects in pending.items():
+        leaves = model._default_manager.in_bulk(
+            [obj.pk for obj in model_objects])
+        for obj in model_objects:
+            leaf = leaves.get(obj.pk)
+            if leaf is not None:
+                leaf._leaf_class = obj._leaf_class = leaf
+    # return the leaves in the original order
+    return [leaf_class(obj) if hasattr(obj, 'as_leaf_class') else obj
+        for obj in objects]
+
+
+class FormFieldFactories(object):
+    """Mapping of model field names to form field factories with extra
+    config applied, building each factory only when it is first
+    accessed.
+
+    """
+
+    def __init__(self, model, extra_config):
+        self.model = model
+        self.extra_config = extra_config
+        self.fields = SortedDict([(field.name, field)
+            for field in model._meta.fields])
+        self.factories = {}
+
+    def __getitem__(self, name):
+        factory = self.factories.get(name)
+        if factory is None:
+            config = self.extra_config.get(name, {})
+            factory = functools.partial(self.fields[name].formfield,
+                **config)
+            self.factories[name] = factory
+        return factory
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.fields.keys()
 
-def formfield_extractor(model, extra_config):
+    def get(self, name, default=None):
+        if name in self.fields: return self[name]
+        return default
+
+    def items(self):
+        return [(name, self[name]) for name in self.fields]
+
+    def values(self):
+        return [self[name] for name in self.fields]
+
+
+# amount of configs remembered before the factories are cleared
+FORMFIELD_CACHE_SIZE = 256
+
+# values compared by value that configs can be remembered with
+FROZEN_TYPES = (type(None), bool, int, long, float, basestring, type)
+
+_formfield_factories = {}
+
+
+def _freeze(value):
+    """Returns a hashable copy of a config, raising TypeError for values
+    like querysets or widget instances that are only hashed by identity
+    and would make a new entry for every call.
+
+    """
+    from django.utils.functional import Promise
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([_freeze(v) for v in value])
+    if isinstance(value, Promise):
+        return ('lazy', unicode(value))
+    if not isinstance(value, FROZEN_TYPES):
+        raise TypeError('%r can not be frozen' % value)
+    return value
+
+
+def formfield_extractor(model, extra_config, lazy=False):
     """Extracts form fields from a model and applies extra config as
-    specified for each field.
+    specified for each field. The factories are remembered per model
+    and config when the config is made of plain values, and with lazy
+    set the shared mapping is returned so factories are only built for
+    the fields used.
     
     """
-    fields = {}
-    for field in model._meta.fields:
-        config = extra_config.get(field.name, {})
-        fields[field.name] = functools.partial(field.formfield, **config)
-    return fields
+    opts = model._meta
+    try:
+        key = (opts.app_label, opts.object_name, _freeze(extra_config))
+    except TypeError:
+        key = None
+    factories = _formfield_factories.get(key) if key else None
+    # build again for a config that can't be remembered or a model
+    # class that has been reloaded
+    if factories is None or factories.model is not model:
+        # remembered configs are copied so later changes by the caller
+        # don't alter the factories shared with other callers
+        if key:
+            extra_config = copy.deepcopy(extra_config)
+        factories = FormFieldFactories(model, extra_config)
+        if key:
+            if len(_formfield_factories) >= FORMFIELD_CACHE_SIZE:
+                _formfield_factories.clear()
+            _formfield_factories[key] = factories
+    if lazy: return factories
+    return dict(factories.items())
+
+
+BASE64_URL_TABLE = string.maketrans('-_', '+/')
 
 
 def base64_url_decode(inp):
     """Base64 URL decoder."""
+    if isinstance(inp, unicode):
+        inp = inp.encode('ascii')
+    elif isinstance(inp, memoryview):
+        inp = inp.tobytes()
     padding_factor = (4 - len(inp) % 4) % 4
-    inp += "="*padding_factor
-    return base64.b64decode(unicode(inp).translate(dict(zip(map(ord, u'-_'), u'+/'))))
+    if padding_factor:
+        inp = '%s%s' % (inp, '=' * padding_factor)
+    return base64.b64decode(inp.translate(BASE64_URL_TABLE))
+
+
+# amount of verified signed requests remembered
+SIGNED_REQUEST_CACHE_SIZE = 256
+
+_signed_requests = OrderedDict()
+_signed_requests_lock = threading.Lock()
+
+
+def parse_signed_request(signed_request, secret):
+    """Verifies and decodes a 'signature.payload' signed request,
+    returning the payload data or None if it is invalid. Verified
+    requests are remembered so repeats skip the work.
+
+    """
+    if isinstance(signed_request, unicode):
+        signed_request = signed_request.encode('ascii', 'replace')
+    key = (signed_request, secret)
+    with _signed_requests_lock:
+        data = _signed_requests.pop(key, None)
+        if data is not None:
+            _signed_requests[key] = data
+            return dict(data)
+    # split and decode the request
+    try:
+        signature, payload = signed_request.split('.', 1)
+        signature = base64_url_decode(signature)
+        data = json.loads(base64_url_decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    algorithm = data.get('algorithm')
+    if not isinstance(algorithm, basestring) or \
+        algorithm.upper() != 'HMAC-SHA256':
+        return None
+    # verify the signature
+    expected = hmac.new(secret, payload, hashlib.sha256).digest()
+    if not constant_time_compare(signature, expected):
+        return None
+    with _signed_requests_lock:
+        _signed_requests[key] = data
+        while len(_signed_requests) > SIGNED_REQUEST_CACHE_SIZE:
+            _signed_requests.popitem(last=False)
+    return dict(data)
@@ -0,0 +1,142 @@
+"""Warmup of the content type and url caches before workers are forked.
+
+Call warmup() from the master process, for example in a gunicorn
+when_ready or pre_fork hook with the application preloaded, so workers
+inherit the filled caches. Without preloading, write a snapshot with
+the warm_caches management command and call load_snapshot() when a
+worker boots to fill the caches from the parsed file instead of the
+database.
+
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+from django import db
+from django.conf import settings
+from django.core.urlresolvers import get_resolver, get_urlconf, \
+    NoReverseMatch
+from django.contrib.contenttypes.models import ContentType
+
+from panomena_general import url_builders
+from panomena_general.utils import cached_setting
+from panomena_general.content_types import content_types
+
+
+# version of the snapshot format, bumped when it changes
+SNAPSHOT_VERSION = 3
+
+
+def warmup(urls=None, object_views=None):
+    """Fills the content type registry, the url resolver and the url
+    caches. The urls reversed are given as (view, args) tuples and the
+    content object views are compiled for every content type, defaulting
+    to the PANOMENA_WARMUP_URLS and PANOMENA_WARMUP_OBJECT_VIEWS settings.
+    The database connections are closed afterwards so forked workers
+    don't share them.
+
+    """
+    if urls is None:
+        urls = cached_setting('PANOMENA_WARMUP_URLS', ())
+    if object_views is None:
+        object_views = cached_setting('PANOMENA_WARMUP_OBJECT_VIEWS', ())
+    try:
+        content_types.load()
+        # populate the resolver used by reverse and the url tags
+        get_resolver(get_urlconf()).reverse_dict
+        for view, args in urls:
+            try:
+                url_builders.cached_reverse(view, args=args)
+            except NoReverseMatch:
+                pass
+        for view in object_views:
+            for content_type in content_types.all():
+                url_builders.get_url_builder(view, '%s.%s' % (
+                    content_type.app_label, content_type.model))
+    finally:
+        for connection in db.connections.all():
+            connection.close()
+
+
+def _pattern_lines(patterns, prefix=''):
+    # one line per url pattern with its full regex, name and view
+    for pattern in patterns:
+        regex = prefix + pattern.regex.pattern
+        if hasattr(pattern, 'url_patterns'):
+            yield '%s include %s %s' % (regex,
+                getattr(pattern, 'namespace', None),
+                getattr(pattern, 'app_name', None))
+            for line in _pattern_lines(pattern.url_patterns, regex):
+                yield line
+        else:
+            callback = getattr(pattern, '_callback_str', None) or \
+                getattr(pattern, 'callback', None)
+            if not isinstance(callback, basestring):
+                callback = '%s.%s' % (getattr(callback, '__module__', ''),
+                    getattr(callback, '__name__', repr(callback)))
+            yield '%s %s %s %r' % (regex, pattern.name, callback,
+                sorted(pattern.default_args.items()))
+
+
+def urlconf_digest():
+    """Returns a digest of the url patterns, so snapshots written for
+    other url patterns are not loaded.
+
+    """
+    resolver = get_resolver(get_urlconf())
+    digest = hashlib.sha1()
+    for line in _pattern_lines(resolver.url_patterns):
+        digest.update(line.encode('utf-8') if isinstance(line, unicode)
+            else line)
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+def _snapshot_header():
+    return {
+        'version': SNAPSHOT_VERSION,
+        'urlconf': getattr(settings, 'ROOT_URLCONF', None),
+        'patterns': urlconf_digest(),
+        'deploy': cached_setting('PANOMENA_WARMUP_VERSION', None),
+    }
+
+
+def write_snapshot(path):
+    """Writes the warm caches to a snapshot file, replacing any existing
+    file at once so workers never read a partial snapshot.
+
+    """
+    fields = [field.name for field in ContentType._meta.fields]
+    data = _snapshot_header()
+    data['content_types'] = [dict([(name, getattr(content_type, name))
+        for name in fields]) for content_type in content_types.all()]
+    data['reversals'] = url_builders.export_reversals()
+    data['builders'] = url_builders.export_builders()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_path, path)
+
+
+def load_snapshot(path):
+    """Fills the caches from a snapshot file, returning False when the
+    file is missing or was written for another version, url patterns or
+    deploy.
+
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return False
+    header = _snapshot_header()
+    if not isinstance(data, dict) or \
+        dict([(k, data.get(k)) for k in header]) != header:
+        return False
+    content_types.install([ContentType(**dict([(str(k), v)
+        for k, v in fields.items()])) for fields in data['content_types']])
+    url_builders.import_reversals(data['reversals'])
+    url_builders.import_builders(data['builders'])
+    return True